@@ -0,0 +1,114 @@
+import argparse
+import os
+import sys
+import time
+from typing import Dict, List
+
+import torch
+import torch.nn as nn
+import torchvision.models as models
+
+# The hooks and reducers live next to the training code
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "vit"))
+from attention_stats import CLSAttentionMap
+from mean_attention_distance import attach_torchvision_reducer
+
+
+class TorchvisionAttentionRecorder(object):
+    def __init__(self,
+                 model: nn.Module,
+                 layers: List[int] = None,
+                 reducers: List = None,
+                 keep_maps: bool = False,
+                 to_cpu: bool = True):
+        """
+        Opt-in instrumentation that recovers per-head attention probabilities from the
+        encoder layers of a torchvision ViT during the normal forward pass, using the hooks of
+        `attach_torchvision_reducer` (vit/mean_attention_distance.py). The forward pass is not
+        re-run, but the instrumented layers use the non-fused attention path.
+
+        :param model: (nn.Module) torchvision VisionTransformer
+        :param layers: (List) Indices of the encoder layers to instrument (default = all)
+        :param reducers: (List) Objects with an `update(layer_idx, attention_probs)` method that
+                         keep streaming statistics, e.g. the reducers in vit/attention_stats.py
+        :param keep_maps: (bool) Keep the (B, H, N, N) maps of the last batch in `attention_maps`,
+                          keyed by layer index
+        :param to_cpu: (bool) Move kept maps to the CPU
+        """
+        self.model = model
+        self.layers = layers
+        self.reducers = reducers if reducers is not None else []
+        self.keep_maps = keep_maps
+        self.to_cpu = to_cpu
+        self.attention_maps = {}
+        self._handles = []
+
+    def update(self, layer_idx: int, attention_probs: torch.Tensor):
+        for reducer in self.reducers:
+            reducer.update(layer_idx, attention_probs)
+        if self.keep_maps:
+            self.attention_maps[layer_idx] = attention_probs.cpu() if self.to_cpu else attention_probs
+
+    def attach(self):
+        if not self._handles:
+            self._handles = attach_torchvision_reducer(self.model, self, self.layers)
+        return self
+
+    def detach(self):
+        for handle in self._handles:
+            handle.remove()
+        self._handles = []
+
+    def __enter__(self):
+        return self.attach()
+
+    def __exit__(self, *exc):
+        self.detach()
+
+
+def measure_overhead(model: nn.Module,
+                     batch_size: int = 32,
+                     num_iters: int = 10,
+                     num_warmup: int = 2,
+                     device: str = 'cpu') -> Dict:
+    """
+    Times the forward pass of `model` without instrumentation, with a streaming reducer and
+    with all attention maps kept.
+    """
+    model = model.to(device).eval()
+    x = torch.randn(batch_size, 3, model.image_size, model.image_size, device=device)
+
+    def run():
+        with torch.no_grad():
+            for _ in range(num_warmup):
+                model(x)
+            if device != 'cpu':
+                torch.cuda.synchronize()
+            start = time.perf_counter()
+            for _ in range(num_iters):
+                model(x)
+            if device != 'cpu':
+                torch.cuda.synchronize()
+            return (time.perf_counter() - start) / num_iters
+
+    results = {"baseline": run()}
+    with TorchvisionAttentionRecorder(model, reducers=[CLSAttentionMap()]):
+        results["streaming"] = run()
+    with TorchvisionAttentionRecorder(model, keep_maps=True):
+        results["keep_maps"] = run()
+
+    for mode in ("baseline", "streaming", "keep_maps"):
+        print(f"{mode:>10}: {results[mode] * 1000:8.2f} ms/batch "
+              f"({(results[mode] / results['baseline'] - 1) * 100:+.1f}%)")
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--arch", default="vit_b_16")
+    parser.add_argument("--batch_size", default=32, type=int)
+    parser.add_argument("--num_iters", default=10, type=int)
+    parser.add_argument("--device", default="cpu")
+    args = parser.parse_args()
+
+    measure_overhead(models.__dict__[args.arch](), args.batch_size, args.num_iters, device=args.device)
@@ -0,0 +1,53 @@
+import argparse
+import os
+import sys
+
+import torch
+
+from model_compare import CKA
+
+# The quantization helpers and our VisionTransformer live next to the training code
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "vit"))
+from quantize import quantize_model, load_fp32_model, evaluate_top1, time_forward, get_val_loader
+from vit_models import CONFIGS
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", default="vit_b_16",
+                        help="torchvision architecture (e.g. vit_b_16) or one of %s." % ", ".join(CONFIGS))
+    parser.add_argument("--checkpoint", default=None, type=str)
+    parser.add_argument("--data_dir", default="imagenet/val", type=str)
+    parser.add_argument("--num_images", default=2000, type=int)
+    parser.add_argument("--batch_size", default=100, type=int)
+    parser.add_argument("--save_path", default="fp32_vs_int8.png", type=str)
+    args = parser.parse_args()
+
+    fp32_model = load_fp32_model(args.model, args.checkpoint)
+    int8_model = quantize_model(load_fp32_model(args.model, args.checkpoint))
+
+    # Per-block outputs; our ViT's Block returns (x, weights), so its Mlp output is used instead
+    if args.model in CONFIGS:
+        layer_names = [name for name, _ in fp32_model.named_modules() if name.endswith(".ffn")]
+    else:
+        layer_names = [name for name, _ in fp32_model.named_modules()
+                       if name.startswith("encoder.layers.encoder_layer_") and name.count(".") == 2]
+
+    val_loader = get_val_loader(args.model, args.data_dir, args.num_images, batch_size=args.batch_size)
+
+    fp32_accuracy = evaluate_top1(fp32_model, val_loader)
+    int8_accuracy = evaluate_top1(int8_model, val_loader)
+    print(f"Top-1 fp32 {fp32_accuracy:.2f}%, int8 {int8_accuracy:.2f}% (delta {int8_accuracy - fp32_accuracy:+.2f})")
+
+    fp32_time = time_forward(fp32_model, args.batch_size)
+    int8_time = time_forward(int8_model, args.batch_size)
+    print(f"Speedup {fp32_time / int8_time:.2f}x ({args.batch_size / fp32_time:.1f} -> {args.batch_size / int8_time:.1f} images/sec)")
+
+    cka = CKA(fp32_model, int8_model,
+              model1_name=f"{args.model} fp32", model2_name=f"{args.model} int8",
+              device='cpu', model1_layers=layer_names, model2_layers=layer_names)
+    with torch.no_grad():
+        cka.compare(val_loader)
+    print("Per-layer CKA (fp32 vs int8):")
+    for i, name in enumerate(layer_names):
+        print(f"{name}: {cka.hsic_matrix[i, i].item():.4f}")
+    cka.plot_results(save_path=args.save_path)
@@ -1,4 +1,5 @@
 import os
+import sys
 import torch
 import torchvision.models as models
 from torchvision.models import resnet18, resnet34, resnet50, wide_resnet50_2, swin_b
@@ -18,6 +19,10 @@ import matplotlib.pyplot as plt
 from mpl_toolkits import axes_grid1
 import matplotlib.pyplot as plt
 
+# The normalization statistics and the eval cache live next to the training code
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "vit"))
+from utils.data_utils import IMAGENET_MEAN, IMAGENET_STD
+
 def add_colorbar(im, aspect=10, pad_fraction=0.5, **kwargs):
     """Add a vertical color bar to an image plot."""
     divider = axes_grid1.make_axes_locatable(im.axes)
@@ -485,73 +490,85 @@ def seed_worker(worker_id):
     np.random.seed(worker_seed)
     random.seed(worker_seed)
 #===============================================================
-batch_size = 100
-arch = "vit_b_16"
-pretrained = True
-
-model1 = models.__dict__[arch]()
-model2 = models.__dict__[arch]()
-
-state_dict_model_two = torch.load('checkpoints/checkpoint_89.pth')
-
-new_state_dict = {}
-for key, value in state_dict_model_two.items():
-    new_key = key.replace('module.', '')  # Remove 'module.' from the key
-    new_state_dict[new_key] = value
-model2.load_state_dict(new_state_dict)
-model1.load_state_dict(new_state_dict)
-
-path_to_imagenet = "/home/idies/workspace/Temporary/ktuzinows1/scratch/imagenet"
-val_dir = os.path.join(path_to_imagenet, "val")
-normalize = transforms.Normalize(mean=[0.485, 0.456, 0.406],
-                                 std=[0.229, 0.224, 0.225])
-
-val_dataset = datasets.ImageFolder(
-    val_dir,
-    transforms.Compose([
-        transforms.Resize(256),
-        transforms.CenterCrop(224),
-        transforms.ToTensor(),
-        normalize,
-]))
-# Define the number of samples you want in the smaller dataset
-# USE LARGE BATCH SIZE
-num_samples = 10000
-
-# Generate a random list of indices
-indices = np.random.choice(len(val_dataset), num_samples, replace=False)
-
-# Create the subset
-small_val_dataset = Subset(val_dataset, indices)
-
-val_sampler = None
-val_loader = torch.utils.data.DataLoader(
-        small_val_dataset, batch_size=batch_size, shuffle=False,
-        num_workers=4, pin_memory=True, sampler=val_sampler)
-
-model1_layer_names = []
-# CLS token here
-# encoder.layers.encoder_layer_0.self_attention.out_proj
-# counter = 2
-# TODO: Compare tokens pairwise instead of just CLS token
-# TODO: Possibly Average Pool 768 dimension embedding
-# TODO (1): Print outputs of latent representations, and trick to reduce dimensions
-# TODO: Use pretrained model on imagenet, plot mean attention distance for CIFAR10, deep layers high attention/small layers lower attention
-# Include also from scratch ViT on CIFAR10
-for name, layer in model1.named_modules():
-    if 'mlp.4' in name:
-        model1_layer_names.append(name)
-    # if counter == 0:
-    #     break
-    # counter -= 1
-print("Layer names for model1", model1_layer_names)
-model_name = "ViT-B/16 0%"
-model_name1 = "ViT-B/16 100%"
-# torch.cuda.set_device(3)
-cka = CKA(model1, model2,
-        model1_name=model_name, model2_name=model_name1,
-        device='cuda', model1_layers=model1_layer_names, model2_layers=model1_layer_names)
-model1_accuracy, model2_accuracy = cka.get_accuracy_for_models(val_loader)
-print("This is the model1 accuracy", model1_accuracy, "This is the model2 accuracy", model2_accuracy)
-cka.compare(val_loader)
-cka.plot_results(save_path="ViT_B_16_0_vs_100.png")
+if __name__ == "__main__":
+    batch_size = 100
+    arch = "vit_b_16"
+    pretrained = True
+
+    model1 = models.__dict__[arch]()
+    model2 = models.__dict__[arch]()
+
+    state_dict_model_two = torch.load('checkpoints/checkpoint_89.pth')
+
+    new_state_dict = {}
+    for key, value in state_dict_model_two.items():
+        new_key = key.replace('module.', '')  # Remove 'module.' from the key
+        new_state_dict[new_key] = value
+    model2.load_state_dict(new_state_dict)
+    model1.load_state_dict(new_state_dict)
+
+    path_to_imagenet = "/home/idies/workspace/Temporary/ktuzinows1/scratch/imagenet"
+    val_dir = os.path.join(path_to_imagenet, "val")
+    normalize = transforms.Normalize(mean=IMAGENET_MEAN, std=IMAGENET_STD)
+
+    # Set to a directory to decode and resize the val set once into a uint8 memory-mapped
+    # cache (see vit/cache_eval_set.py) and normalize on the device instead of per image
+    eval_cache_root = None
+    collate_fn = None
+    if eval_cache_root is not None:
+        from utils.eval_cache import EvalCacheDataset, build_eval_cache, attach_input_normalization, \
+            collate_eval_cache
+        collate_fn = collate_eval_cache
+        val_dataset = EvalCacheDataset(build_eval_cache(val_dir, eval_cache_root, 224, resize_size=256))
+        for model in (model1, model2):
+            attach_input_normalization(model, normalize.mean, normalize.std)
+    else:
+        val_dataset = datasets.ImageFolder(
+            val_dir,
+            transforms.Compose([
+                transforms.Resize(256),
+                transforms.CenterCrop(224),
+                transforms.ToTensor(),
+                normalize,
+        ]))
+    # Define the number of samples you want in the smaller dataset
+    # USE LARGE BATCH SIZE
+    num_samples = 10000
+
+    # Generate a random list of indices
+    indices = np.random.choice(len(val_dataset), num_samples, replace=False)
+
+    # Create the subset
+    small_val_dataset = Subset(val_dataset, indices)
+
+    val_sampler = None
+    val_loader = torch.utils.data.DataLoader(
+            small_val_dataset, batch_size=batch_size, shuffle=False,
+            num_workers=4, pin_memory=True, sampler=val_sampler, collate_fn=collate_fn)
+
+    model1_layer_names = []
+    # CLS token here
+    # encoder.layers.encoder_layer_0.self_attention.out_proj
+    # counter = 2
+    # TODO: Compare tokens pairwise instead of just CLS token
+    # TODO: Possibly Average Pool 768 dimension embedding
+    # TODO (1): Print outputs of latent representations, and trick to reduce dimensions
+    # TODO: Use pretrained model on imagenet, plot mean attention distance for CIFAR10, deep layers high attention/small layers lower attention
+    # Include also from scratch ViT on CIFAR10
+    for name, layer in model1.named_modules():
+        if 'mlp.4' in name:
+            model1_layer_names.append(name)
+        # if counter == 0:
+        #     break
+        # counter -= 1
+    print("Layer names for model1", model1_layer_names)
+    model_name = "ViT-B/16 0%"
+    model_name1 = "ViT-B/16 100%"
+    # torch.cuda.set_device(3)
+    cka = CKA(model1, model2,
+            model1_name=model_name, model2_name=model_name1,
+            device='cuda', model1_layers=model1_layer_names, model2_layers=model1_layer_names)
+    model1_accuracy, model2_accuracy = cka.get_accuracy_for_models(val_loader)
+    print("This is the model1 accuracy", model1_accuracy, "This is the model2 accuracy", model2_accuracy)
+    cka.compare(val_loader)
+    cka.plot_results(save_path="ViT_B_16_0_vs_100.png")
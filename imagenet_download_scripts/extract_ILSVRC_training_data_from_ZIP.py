@@ -1,77 +1,87 @@
-import tarfile
-from concurrent.futures import ThreadPoolExecutor
+import argparse
+import io
 import os
 import shutil
+import tarfile
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
-# Define the directory and file paths
-train_directory = "imagenet/train"
-file_to_move = "ILSVRC2012_img_train.tar"
-
-# Create imagenet/train directory (including parent direcories if they don't exist)
-os.makedirs(train_directory, exist_ok=True)
-
-# Create file path to move tar into
-move_train_tar_file_path = os.path.join(train_directory, os.path.basename(file_to_move))
 
-# Move ILSVRC2012_img_train.tar to the imagenet/train directory
-shutil.move(file_to_move, move_train_tar_file_path)
+def extract_class_tar(data, extract_to):
+    """
+    Unpacks the JPEGs of one in-memory class tar (e.g. n01440764.tar) into extract_to.
+    Returns the number of files and bytes written.
+    """
+    os.makedirs(extract_to, exist_ok=True)
+    num_files, num_bytes = 0, 0
+    with tarfile.open(fileobj=io.BytesIO(data), mode='r|') as tar:
+        for member in tar:
+            if not member.isfile():
+                continue
+            # Class tars are flat; basename also keeps members from escaping extract_to
+            with open(os.path.join(extract_to, os.path.basename(member.name)), 'wb') as f:
+                shutil.copyfileobj(tar.extractfile(member), f)
+            num_files += 1
+            num_bytes += member.size
+    return num_files, num_bytes
 
-print(f"Moved {file_to_move} to {move_train_tar_file_path}")
 
-def extract_member(tar_path, member, extract_to="."):
-    with tarfile.open(tar_path, 'r') as tar:
-        tar.extract(member, path=extract_to)
+def extract_train_tar(tar_path, extract_to="imagenet/train", num_workers=16, max_pending=None):
+    """
+    Extracts ILSVRC2012_img_train.tar in a single sequential pass.
+    The outer tar is read as a stream; the bytes of each inner class tar are handed to a
+    thread pool that writes its JPEGs straight into extract_to/<wnid>/, so no intermediate
+    class tars are written to (and read back from) disk.
+    At most max_pending class tars (~140 MB each) are held in memory at once.
+    """
+    max_pending = max_pending or 2 * num_workers
+    os.makedirs(extract_to, exist_ok=True)
+    total_size = os.path.getsize(tar_path)
+    start_time = time.time()
+    read_bytes, written_files, written_bytes, num_classes = 0, 0, 0, 0
 
-def extract_tar_parallel(tar_path, extract_to=".", num_workers=32):
-    with tarfile.open(tar_path, 'r') as tar:
-        members = tar.getmembers()
-    with ThreadPoolExecutor(max_workers=num_workers) as executor:
-        for member in members:
-            executor.submit(extract_member, tar_path, member, extract_to)
+    def collect(done):
+        nonlocal written_files, written_bytes, num_classes
+        for future in done:
+            files, size = future.result()
+            written_files += files
+            written_bytes += size
+            num_classes += 1
+        elapsed = time.time() - start_time
+        print(f"[{num_classes} classes] read {read_bytes / 1e9:.1f}/{total_size / 1e9:.1f} GB "
+              f"({read_bytes / 1e6 / elapsed:.0f} MB/s), wrote {written_files} files "
+              f"({written_bytes / 1e6 / elapsed:.0f} MB/s)")
 
-    # Remove the tar file after extraction
-    os.remove(tar_path)
-    print(f"Removed tar file: {tar_path}")
+    pending = set()
+    with ThreadPoolExecutor(max_workers=num_workers) as executor, tarfile.open(tar_path, 'r|') as tar:
+        for member in tar:
+            if not member.isfile() or not member.name.endswith(".tar"):
+                continue
+            data = tar.extractfile(member).read()
+            read_bytes += member.size
+            wnid = os.path.basename(member.name)[:-4]
+            pending.add(executor.submit(extract_class_tar, data, os.path.join(extract_to, wnid)))
+            if len(pending) >= max_pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                collect(done)
+        done, _ = wait(pending)
+        collect(done)
 
-def extract_tar(tar_path, extract_to="."):
-    """
-    Extracts a tar file to a specified directory
-    """
-    with tarfile.open(tar_path, 'r') as tar:
-        tar.extractall(path=extract_to)
-    print(f"Extracted {tar_path} to {extract_to}")
+    elapsed = time.time() - start_time
+    print(f"Extracted {written_files} images in {num_classes} classes to {extract_to} in {elapsed:.0f} s")
 
-def extract_nested_tars(base_dir, num_workers=32):
-    """
-    Finds and extracts all tar files in a base directory, extracts their contents
-    into corresponding directories, and deletes the tar files
-    """
-    # Find all tar files within the base directory
-    nested_tar_files = []
-    for root, _, files in os.walk(base_dir):
-        for file in files:
-            if file.endswith(".tar"):
-                nested_tar_files.append(os.path.join(root, file))
-    
-    def process_nested_tar(nested_tar_path):
-        """
-        Process a single nested tar file: extract it and then delete it.
-        """
-        # Create a directory for the extracted contents
-        extract_dir = nested_tar_path[:-4] # Remove the ".tar" extension
-        os.makedirs(extract_dir, exist_ok=True)
-        # Extract the nested tar file
-        extract_tar(nested_tar_path, extract_to=extract_dir)
-        # Remove the tar file after extraction
-        os.remove(nested_tar_path)
-        print(f"Removed {nested_tar_path}")
-    
-    # Use ThreadPoolExecutor to process nested tar files in parallel
-    with ThreadPoolExecutor(max_workers=num_workers) as executor:
-        executor.map(process_nested_tar, nested_tar_files)
 
-# Define paths
-extract_to_directory = "imagenet/train"
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tar_path", default="ILSVRC2012_img_train.tar")
+    parser.add_argument("--extract_to", default="imagenet/train")
+    parser.add_argument("--num_workers", default=16, type=int)
+    parser.add_argument("--max_pending", default=None, type=int,
+                        help="Class tars held in memory at once (default = 2 * num_workers).")
+    parser.add_argument("--remove_tar", action="store_true", help="Delete the train tar after extraction.")
+    args = parser.parse_args()
 
-extract_tar_parallel(move_train_tar_file_path, extract_to=extract_to_directory)
-extract_nested_tars(extract_to_directory)
+    extract_train_tar(args.tar_path, args.extract_to, args.num_workers, args.max_pending)
+    if args.remove_tar:
+        os.remove(args.tar_path)
+        print(f"Removed tar file: {args.tar_path}")
@@ -1,39 +1,114 @@
-import tarfile
-from concurrent.futures import ThreadPoolExecutor
+import argparse
+import csv
+import io
 import os
 import shutil
+import tarfile
+import time
+
+
+def load_devkit_labels(devkit_path):
+    """
+    Reads the validation labels from the ILSVRC2012 devkit (ILSVRC2012_devkit_t12.tar.gz or its
+    extracted folder): data/ILSVRC2012_validation_ground_truth.txt holds one ILSVRC2012_ID per
+    image in order, and data/meta.mat maps those IDs to WordNet IDs. Needs scipy.
+    """
+    try:
+        from scipy.io import loadmat
+    except ImportError:
+        raise ImportError("Reading meta.mat from the devkit needs scipy; "
+                          "alternatively pass a LOC_val_solution.csv or a '<file> <wnid>' text file")
+
+    if os.path.isdir(devkit_path):
+        def read(name):
+            matches = [os.path.join(root, name) for root, _, files in os.walk(devkit_path) if name in files]
+            with open(matches[0], 'rb') as f:
+                return f.read()
+    else:
+        with tarfile.open(devkit_path, 'r:*') as tar:
+            contents = {os.path.basename(m.name): tar.extractfile(m).read()
+                        for m in tar.getmembers() if m.isfile()}
 
-# Define the directory and file paths
-test_directory = "imagenet/val"
-file_to_move = "ILSVRC2012_img_val.tar"
+        def read(name):
+            return contents[name]
 
-# Create imagenet/train directory (including parent direcories if they don't exist)
-os.makedirs(test_directory, exist_ok=True)
+    synsets = loadmat(io.BytesIO(read("meta.mat")), squeeze_me=True)["synsets"]
+    id_to_wnid = {int(s["ILSVRC2012_ID"]): str(s["WNID"]) for s in synsets if int(s["num_children"]) == 0}
+    ground_truth = read("ILSVRC2012_validation_ground_truth.txt").decode().split()
+    return {"ILSVRC2012_val_%08d.JPEG" % (idx + 1): id_to_wnid[int(label)]
+            for idx, label in enumerate(ground_truth)}
 
-# Create file path to move tar into
-move_test_tar_file_path = os.path.join(test_directory, os.path.basename(file_to_move))
 
-# Move ILSVRC2012_img_train.tar to the imagenet/train directory
-shutil.move(file_to_move, move_test_tar_file_path)
+def load_labels(labels_path):
+    """
+    Returns {image file name: wnid} from one of:
+      - the ILSVRC2012 devkit (.tar.gz or folder, see load_devkit_labels)
+      - LOC_val_solution.csv from the Kaggle ImageNet localization challenge
+      - a text file with one '<file name> <wnid>' pair per line (the format valprep.sh encodes)
+    """
+    if os.path.isdir(labels_path) or labels_path.endswith((".tar.gz", ".tgz", ".tar")):
+        return load_devkit_labels(labels_path)
+    labels = {}
+    with open(labels_path, newline='') as f:
+        if labels_path.endswith(".csv"):
+            for row in csv.DictReader(f):
+                labels[row["ImageId"] + ".JPEG"] = row["PredictionString"].split()[0]
+        else:
+            for line in f:
+                fields = line.split()
+                if len(fields) >= 2:
+                    labels[os.path.basename(fields[0])] = fields[1]
+    return labels
 
-print(f"Moved {file_to_move} to {move_test_tar_file_path}")
 
-def extract_member(tar_path, member, extract_to="."):
-    with tarfile.open(tar_path, 'r') as tar:
-        tar.extract(member, path=extract_to)
+def extract_val_tar(tar_path, extract_to="imagenet/val", labels=None):
+    """
+    Extracts ILSVRC2012_img_val.tar in a single streaming pass. With `labels`
+    ({file name: wnid}) every image is written directly into extract_to/<wnid>/,
+    otherwise the images are written flat into extract_to.
+    """
+    os.makedirs(extract_to, exist_ok=True)
+    start_time = time.time()
+    num_files, missing = 0, []
+    with tarfile.open(tar_path, 'r|') as tar:
+        for member in tar:
+            if not member.isfile():
+                continue
+            name = os.path.basename(member.name)
+            out_dir = extract_to
+            if labels is not None:
+                if name not in labels:
+                    missing.append(name)
+                    continue
+                out_dir = os.path.join(extract_to, labels[name])
+                os.makedirs(out_dir, exist_ok=True)
+            with open(os.path.join(out_dir, name), 'wb') as f:
+                shutil.copyfileobj(tar.extractfile(member), f)
+            num_files += 1
+            if num_files % 5000 == 0:
+                print(f"Extracted {num_files} images ({num_files / (time.time() - start_time):.0f} images/s)")
 
-def extract_tar_parallel(tar_path, extract_to=".", num_workers=32):
-    with tarfile.open(tar_path, 'r') as tar:
-        members = tar.getmembers()
-    with ThreadPoolExecutor(max_workers=num_workers) as executor:
-        for member in members:
-            executor.submit(extract_member, tar_path, member, extract_to)
+    print(f"Extracted {num_files} images to {extract_to} in {time.time() - start_time:.0f} s")
+    if missing:
+        print(f"Skipped {len(missing)} images without a label, e.g. {missing[:3]}")
 
-    # Remove the tar file after extraction
-    os.remove(tar_path)
-    print(f"Removed tar file: {tar_path}")
 
-# Define paths
-extract_to_directory = "imagenet/val"
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tar_path", default="ILSVRC2012_img_val.tar")
+    parser.add_argument("--extract_to", default="imagenet/val")
+    parser.add_argument("--labels", default=None,
+                        help="Devkit (ILSVRC2012_devkit_t12.tar.gz or folder), LOC_val_solution.csv or a "
+                        "'<file> <wnid>' text file. Without it the images are extracted flat and still "
+                        "need create_folders_for_validation_data.sh.")
+    parser.add_argument("--remove_tar", action="store_true", help="Delete the val tar after extraction.")
+    args = parser.parse_args()
 
-extract_tar_parallel(move_test_tar_file_path, extract_to=extract_to_directory)
+    labels = None
+    if args.labels is not None:
+        labels = load_labels(args.labels)
+        print(f"Loaded {len(labels)} labels from {args.labels}")
+    extract_val_tar(args.tar_path, args.extract_to, labels)
+    if args.remove_tar:
+        os.remove(args.tar_path)
+        print(f"Removed tar file: {args.tar_path}")
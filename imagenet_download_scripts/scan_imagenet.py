@@ -0,0 +1,150 @@
+import argparse
+import os
+import time
+from multiprocessing import Pool
+
+import numpy as np
+from PIL import Image
+
+IMG_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.ppm', '.bmp', '.pgm', '.tif', '.tiff', '.webp')
+COLUMNS = ("paths", "width", "height", "channels", "mode", "bytes", "ok", "error")
+
+
+def list_images(root):
+    """Relative paths of all images in the class directories of `root` (or in `root` itself), sorted."""
+    rel_dirs = sorted(entry.name for entry in os.scandir(root) if entry.is_dir()) or ["."]
+    return [os.path.normpath(os.path.join(rel_dir, name))
+            for rel_dir in rel_dirs
+            for name in sorted(os.listdir(os.path.join(root, rel_dir)))
+            if name.lower().endswith(IMG_EXTENSIONS)]
+
+
+def scan_files(args):
+    """
+    Opens and fully decodes every image in a chunk of relative paths under `root`.
+    Returns one column per field; files that fail to decode get ok=False and the error message.
+    """
+    root, chunk_idx, rel_paths = args
+    columns = {name: [] for name in COLUMNS}
+    for rel_path in rel_paths:
+        path = os.path.join(root, rel_path)
+        width = height = channels = 0
+        mode, error = "", ""
+        try:
+            with Image.open(path) as img:
+                width, height = img.size
+                mode = img.mode
+                channels = len(img.getbands())
+                img.load()
+        except Exception as e:
+            error = "%s: %s" % (type(e).__name__, e)
+        columns["paths"].append(rel_path)
+        columns["width"].append(width)
+        columns["height"].append(height)
+        columns["channels"].append(channels)
+        columns["mode"].append(mode)
+        columns["bytes"].append(os.path.getsize(path))
+        columns["ok"].append(not error)
+        columns["error"].append(error)
+    return chunk_idx, columns
+
+
+def save_columns(path, columns):
+    tmp_path = path + ".tmp.npz"
+    np.savez(tmp_path,
+             paths=np.asarray(columns["paths"], dtype=np.str_),
+             width=np.asarray(columns["width"], dtype=np.int32),
+             height=np.asarray(columns["height"], dtype=np.int32),
+             channels=np.asarray(columns["channels"], dtype=np.uint8),
+             mode=np.asarray(columns["mode"], dtype=np.str_),
+             bytes=np.asarray(columns["bytes"], dtype=np.int64),
+             ok=np.asarray(columns["ok"], dtype=bool),
+             error=np.asarray(columns["error"], dtype=np.str_))
+    os.replace(tmp_path, path)
+
+
+def scan_dataset(root, output_path, num_workers=16, chunk_size=1000):
+    """
+    Scans every image under an ImageFolder-style `root` (or a flat folder of images) with
+    `num_workers` processes and writes a columnar manifest (.npz) with the relative path,
+    width, height, channels, PIL mode, file size and decode status of every image.
+    The files are scanned in chunks of `chunk_size`, and finished chunks are kept in
+    <output_path>.parts/ together with the file list, so an interrupted scan picks up where
+    it stopped, also within a single large directory.
+    """
+    parts_dir = output_path + ".parts"
+    os.makedirs(parts_dir, exist_ok=True)
+    # The chunks of an interrupted scan must be cut from the same list
+    files_path = os.path.join(parts_dir, "files.npz")
+    if os.path.exists(files_path):
+        files = np.load(files_path)
+        rel_paths, chunk_size = files["paths"].tolist(), int(files["chunk_size"])
+    else:
+        rel_paths = list_images(root)
+        np.savez(files_path + ".tmp.npz", paths=np.asarray(rel_paths, dtype=np.str_), chunk_size=chunk_size)
+        os.replace(files_path + ".tmp.npz", files_path)
+    chunks = [rel_paths[start:start + chunk_size] for start in range(0, len(rel_paths), chunk_size)] or [[]]
+    part_path = [os.path.join(parts_dir, "%06d.npz" % chunk_idx) for chunk_idx in range(len(chunks))]
+    pending = [chunk_idx for chunk_idx in range(len(chunks)) if not os.path.exists(part_path[chunk_idx])]
+    print(f"Scanning {len(pending)} of {len(chunks)} chunks of {len(rel_paths)} images in {root} "
+          f"({len(chunks) - len(pending)} done by an earlier run)")
+
+    start_time = time.time()
+    num_images = 0
+    with Pool(num_workers) as pool:
+        for done, (chunk_idx, columns) in enumerate(
+                pool.imap_unordered(scan_files, [(root, idx, chunks[idx]) for idx in pending]), 1):
+            save_columns(part_path[chunk_idx], columns)
+            num_images += len(columns["paths"])
+            if done % 50 == 0 or done == len(pending):
+                print(f"[{done}/{len(pending)}] {num_images} images "
+                      f"({num_images / (time.time() - start_time):.0f} images/s)")
+
+    parts = [np.load(path) for path in part_path]
+    merged = {name: np.concatenate([part[name] for part in parts]) for name in COLUMNS}
+    np.savez(output_path + ".tmp.npz", **merged)
+    os.replace(output_path + ".tmp.npz", output_path)
+    for path in part_path + [files_path]:
+        os.remove(path)
+    os.rmdir(parts_dir)
+    return merged
+
+
+def report(manifest, max_listed=20):
+    """Prints the corrupt, CMYK and grayscale files and summary statistics of a scan."""
+    paths = manifest["paths"]
+    mode = manifest["mode"]
+    ok = manifest["ok"]
+    findings = [
+        ("corrupt", ~ok),
+        ("CMYK", ok & (mode == "CMYK")),
+        ("grayscale", ok & np.isin(mode, ["L", "LA", "1", "I", "I;16"])),
+        ("other modes", ok & ~np.isin(mode, ["RGB", "CMYK", "L", "LA", "1", "I", "I;16"])),
+    ]
+    print(f"{len(paths)} images, {manifest['bytes'].sum() / 1e9:.1f} GB")
+    for name, mask in findings:
+        print(f"{name}: {mask.sum()}")
+        for idx in np.flatnonzero(mask)[:max_listed]:
+            detail = manifest["error"][idx] if name == "corrupt" else mode[idx]
+            print(f"    {paths[idx]} ({detail})")
+    if ok.any():
+        aspect = manifest["width"][ok] / manifest["height"][ok]
+        pixels = manifest["width"][ok].astype(np.int64) * manifest["height"][ok]
+        print(f"aspect ratio (w/h) 5/50/95%: {np.percentile(aspect, [5, 50, 95]).round(2).tolist()}")
+        print(f"megapixels 5/50/95%: {(np.percentile(pixels, [5, 50, 95]) / 1e6).round(3).tolist()}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data_dirs", nargs="+", default=["imagenet/train", "imagenet/val"])
+    parser.add_argument("--num_workers", default=os.cpu_count(), type=int)
+    parser.add_argument("--chunk_size", default=1000, type=int, help="Images per checkpointed chunk.")
+    parser.add_argument("--max_listed", default=20, type=int, help="Files listed per finding.")
+    args = parser.parse_args()
+
+    for data_dir in args.data_dirs:
+        # Kept next to (not inside) the folder, so that it does not show up as a class
+        output_path = os.path.normpath(data_dir) + ".scan.npz"
+        manifest = scan_dataset(data_dir, output_path, args.num_workers, args.chunk_size)
+        print(f"Wrote {output_path}")
+        report(manifest, args.max_listed)
@@ -0,0 +1,74 @@
+import logging
+
+import torch
+
+from tqdm import tqdm
+
+logger = logging.getLogger(__name__)
+
+
+class AttentionReducer(object):
+    """
+    Base class for per-layer reducers of attention probabilities.
+    `update` is called inside `Attention.forward` with the (B, H, N, N) probabilities of one
+    layer. Subclasses implement `reduce`, which turns them into a per-sample statistic, and
+    only the running sum of that statistic is kept, so the full tensor can be freed right away.
+    Mean attention distance lives in mean_attention_distance.py.
+    """
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.sums = {}
+        self.counts = {}
+
+    def reduce(self, attention_probs):
+        raise NotImplementedError
+
+    def update(self, layer_idx, attention_probs):
+        with torch.no_grad():
+            stat = self.reduce(attention_probs.float()).sum(dim=0)
+        if layer_idx in self.sums:
+            self.sums[layer_idx] += stat
+        else:
+            self.sums[layer_idx] = stat
+            self.counts[layer_idx] = 0
+        self.counts[layer_idx] += attention_probs.size(0)
+
+    def result(self):
+        """Returns the dataset mean of the statistic per layer."""
+        return {layer_idx: (self.sums[layer_idx] / self.counts[layer_idx]).cpu()
+                for layer_idx in sorted(self.sums)}
+
+
+class AttentionEntropy(AttentionReducer):
+    """Entropy of the attention distribution per head, averaged over the query tokens."""
+    def reduce(self, attention_probs):
+        entropy = -(attention_probs * torch.log(attention_probs.clamp_min(1e-12))).sum(dim=-1)
+        return entropy.mean(dim=-1)
+
+
+class CLSAttentionMap(AttentionReducer):
+    """Attention from the CLS token to every patch token per head."""
+    def __init__(self, num_cls_tokens=1):
+        self.num_cls_tokens = num_cls_tokens
+        super(CLSAttentionMap, self).__init__()
+
+    def reduce(self, attention_probs):
+        return attention_probs[:, :, 0, self.num_cls_tokens:]
+
+
+def accumulate_attention_stats(model, loader, reducers, device="cpu"):
+    """Runs `model` (a `VisionTransformer`) over `loader` and accumulates `reducers` over the whole dataset."""
+    encoder = model.transformer.encoder
+    for reducer in reducers:
+        encoder.add_attention_reducer(reducer)
+    model.eval()
+    try:
+        with torch.no_grad():
+            for x, *_ in tqdm(loader, desc="Accumulating attention statistics"):
+                model(x.to(device))
+    finally:
+        for reducer in reducers:
+            encoder.remove_attention_reducer(reducer)
+    return [reducer.result() for reducer in reducers]
@@ -0,0 +1,158 @@
+import argparse
+import json
+import logging
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+
+from datetime import datetime
+from functools import partial
+
+import torch
+
+from vit_models import VisionTransformer, CONFIGS
+
+logger = logging.getLogger(__name__)
+
+
+def time_iterations(fn, num_iters, num_warmup):
+    for _ in range(num_warmup):
+        fn()
+    start_time = time.perf_counter()
+    for _ in range(num_iters):
+        fn()
+    return (time.perf_counter() - start_time) / num_iters
+
+
+def time_blocks(model, x, num_iters):
+    """Average forward latency of every encoder `Block`, measured with forward hooks."""
+    starts, totals = {}, {}
+
+    def pre_hook(idx, module, args):
+        starts[idx] = time.perf_counter()
+
+    def post_hook(idx, module, args, output):
+        totals[idx] = totals.get(idx, 0.0) + time.perf_counter() - starts[idx]
+
+    handles = []
+    for idx, block in enumerate(model.transformer.encoder.layer):
+        handles.append(block.register_forward_pre_hook(partial(pre_hook, idx)))
+        handles.append(block.register_forward_hook(partial(post_hook, idx)))
+    try:
+        with torch.no_grad():
+            for _ in range(num_iters):
+                model(x)
+    finally:
+        for handle in handles:
+            handle.remove()
+    return [totals[idx] / num_iters * 1000.0 for idx in sorted(totals)]
+
+
+def run_single(model_type, batch_size, num_threads, img_size=224, num_iters=5, num_warmup=2):
+    """Measures one (config, batch size, thread count) point. Meant to run in its own process."""
+    torch.set_num_threads(num_threads)
+    torch.manual_seed(0)
+    config = CONFIGS[model_type]
+    model = VisionTransformer(config, img_size, num_classes=1000)
+    x = torch.randn(batch_size, 3, img_size, img_size)
+    y = torch.randint(0, 1000, (batch_size,))
+
+    model.eval()
+    with torch.no_grad():
+        forward_time = time_iterations(lambda: model(x), num_iters, num_warmup)
+    block_ms = time_blocks(model, x, num_iters)
+
+    vis_model = VisionTransformer(config, img_size, num_classes=1000, vis=True).eval()
+    vis_model.load_state_dict(model.state_dict())
+    with torch.no_grad():
+        vis_forward_time = time_iterations(lambda: vis_model(x), num_iters, num_warmup)
+    del vis_model
+
+    model.train()
+
+    def train_step():
+        loss = model(x, y)
+        loss.backward()
+        model.zero_grad(set_to_none=True)
+
+    train_time = time_iterations(train_step, num_iters, num_warmup)
+
+    return {
+        "model_type": model_type,
+        "batch_size": batch_size,
+        "num_threads": num_threads,
+        "img_size": img_size,
+        "num_params_m": sum(p.numel() for p in model.parameters()) / 1e6,
+        "forward_images_per_sec": batch_size / forward_time,
+        "forward_backward_images_per_sec": batch_size / train_time,
+        "vis_forward_images_per_sec": batch_size / vis_forward_time,
+        "vis_overhead": vis_forward_time / forward_time - 1.0,
+        "block_forward_ms": block_ms,
+        # ru_maxrss is in kilobytes on Linux
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0,
+    }
+
+
+def run_in_subprocess(point):
+    """Runs `run_single` in a fresh interpreter so that peak RSS belongs to this point alone."""
+    cmd = [sys.executable, os.path.abspath(__file__), "--single", json.dumps(point)]
+    result = subprocess.run(cmd, capture_output=True, text=True)
+    if result.returncode != 0:
+        logger.warning("Benchmark %s failed:\n%s" % (point, result.stderr[-2000:]))
+        return dict(point, error=result.stderr.strip().splitlines()[-1] if result.stderr.strip() else "failed")
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model_types", nargs="+", default=["testing", "ViT-Ti_16", "ViT-S_16", "ViT-B_16"],
+                        choices=list(CONFIGS.keys()),
+                        help="Configs to benchmark. ViT-L_16 and ViT-H_14 are slow on CPU; add them explicitly.")
+    parser.add_argument("--batch_sizes", nargs="+", type=int, default=[1, 8, 32])
+    parser.add_argument("--num_threads", nargs="+", type=int, default=[torch.get_num_threads()])
+    parser.add_argument("--img_size", default=224, type=int)
+    parser.add_argument("--num_iters", default=5, type=int)
+    parser.add_argument("--num_warmup", default=2, type=int)
+    parser.add_argument("--output", default="benchmark_results.json", type=str,
+                        help="JSON file the results are written to, for regression tracking.")
+    parser.add_argument("--single", default=None, type=str, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.single is not None:
+        print(json.dumps(run_single(**json.loads(args.single))))
+        return
+
+    logging.basicConfig(format="%(asctime)s - %(levelname)s - %(name)s - %(message)s",
+                        datefmt='%m/%d/%Y %H:%M:%S',
+                        level=logging.INFO)
+    results = []
+    for model_type in args.model_types:
+        for num_threads in args.num_threads:
+            for batch_size in args.batch_sizes:
+                result = run_in_subprocess({"model_type": model_type, "batch_size": batch_size,
+                                            "num_threads": num_threads, "img_size": args.img_size,
+                                            "num_iters": args.num_iters, "num_warmup": args.num_warmup})
+                results.append(result)
+                if "error" not in result:
+                    logger.info("%-10s bs %3d threads %2d: fwd %8.1f img/s, fwd+bwd %8.1f img/s, "
+                                "vis +%.0f%%, peak RSS %.0f MB"
+                                % (model_type, batch_size, num_threads, result["forward_images_per_sec"],
+                                   result["forward_backward_images_per_sec"], result["vis_overhead"] * 100,
+                                   result["peak_rss_mb"]))
+
+    with open(args.output, "w") as f:
+        json.dump({
+            "timestamp": datetime.now().isoformat(),
+            "torch_version": torch.__version__,
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "results": results,
+        }, f, indent=2)
+    logger.info("Wrote %d results to %s" % (len(results), args.output))
+
+
+if __name__ == "__main__":
+    main()
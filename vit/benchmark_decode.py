@@ -0,0 +1,81 @@
+import argparse
+import logging
+import os
+import time
+
+from torch.utils.data import DataLoader, Dataset
+from torchvision import transforms
+from torchvision.datasets.folder import pil_loader
+
+from utils.data_utils import benchmark_loader
+from utils.jpeg_draft import DraftRandomResizedCrop, lazy_pil_loader
+
+logger = logging.getLogger(__name__)
+
+class FileListDataset(Dataset):
+    def __init__(self, paths, loader, transform):
+        self.paths = paths
+        self.loader = loader
+        self.transform = transform
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __getitem__(self, index):
+        return self.transform(self.loader(self.paths[index])), 0
+
+def list_images(data_dir, num_images):
+    """The first `num_images` images of an ImageFolder-style directory, a few from every class."""
+    classes = sorted(entry.path for entry in os.scandir(data_dir) if entry.is_dir())
+    per_class = max(1, num_images // max(len(classes), 1))
+    paths = []
+    for class_dir in classes:
+        paths += [os.path.join(class_dir, name) for name in sorted(os.listdir(class_dir))[:per_class]]
+        if len(paths) >= num_images:
+            break
+    return paths[:num_images]
+
+def cpu_per_image(paths, loader, transform):
+    """Process CPU time per image, in ms, of decoding plus transforming in this process."""
+    start = time.process_time()
+    for path in paths:
+        transform(loader(path))
+    return (time.process_time() - start) / len(paths) * 1000.0
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data_dir", default="imagenet/train", type=str)
+    parser.add_argument("--num_images", default=1000, type=int)
+    parser.add_argument("--img_size", default=224, type=int)
+    parser.add_argument("--batch_size", default=128, type=int)
+    parser.add_argument("--num_workers", default=8, type=int)
+    args = parser.parse_args()
+
+    logging.basicConfig(format="%(asctime)s - %(levelname)s - %(name)s - %(message)s",
+                        datefmt='%m/%d/%Y %H:%M:%S',
+                        level=logging.INFO)
+
+    paths = list_images(args.data_dir, args.num_images)
+    to_tensor = [transforms.PILToTensor()]
+    variants = {
+        "full decode": (pil_loader, transforms.Compose(
+            [transforms.RandomResizedCrop((args.img_size, args.img_size), scale=(0.05, 1.0))] + to_tensor)),
+        "draft decode": (lazy_pil_loader, transforms.Compose(
+            [DraftRandomResizedCrop(args.img_size, scale=(0.05, 1.0))] + to_tensor)),
+    }
+    results = {}
+    for name, (loader, transform) in variants.items():
+        cpu_ms = cpu_per_image(paths, loader, transform)
+        data_loader = DataLoader(FileListDataset(paths, loader, transform), batch_size=args.batch_size,
+                                 shuffle=True, num_workers=args.num_workers)
+        num_batches = max(1, len(paths) // args.batch_size - 1)
+        throughput = benchmark_loader(data_loader, num_batches=num_batches, num_warmup=1)
+        results[name] = (cpu_ms, throughput)
+        logger.info("%-12s: %.2f ms CPU per image, %.1f images/sec with %d workers"
+                    % (name, cpu_ms, throughput, args.num_workers))
+    full, draft = results["full decode"], results["draft decode"]
+    logger.info("Draft decode: %.2fx less CPU per image, %.2fx loader throughput"
+                % (full[0] / draft[0], draft[1] / full[1]))
+
+if __name__ == "__main__":
+    main()
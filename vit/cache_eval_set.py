@@ -0,0 +1,55 @@
+import argparse
+import logging
+
+from torch.utils.data import DataLoader
+from torchvision import transforms, datasets
+
+from utils.data_utils import benchmark_loader, NORM_MEAN, NORM_STD
+from utils.eval_cache import EvalCacheDataset, build_eval_cache, get_cache_transform, collate_eval_cache
+
+logger = logging.getLogger(__name__)
+
+def compare_loaders(data_dir, cache_dir, img_size, resize_size, batch_size=256, num_workers=8, num_batches=50):
+    """Eval loader images/sec decoding the JPEGs against reading the uint8 cache."""
+    transform = transforms.Compose(get_cache_transform(img_size, resize_size).transforms[:-1] + [
+        transforms.ToTensor(),
+        transforms.Normalize(mean=NORM_MEAN, std=NORM_STD),
+    ])
+    folder_loader = DataLoader(datasets.ImageFolder(data_dir, transform=transform), batch_size=batch_size,
+                               num_workers=num_workers, pin_memory=True)
+    cache_loader = DataLoader(EvalCacheDataset(cache_dir), batch_size=batch_size,
+                              num_workers=num_workers, pin_memory=True, collate_fn=collate_eval_cache)
+
+    folder_throughput = benchmark_loader(folder_loader, num_batches=num_batches, num_warmup=num_workers)
+    cache_throughput = benchmark_loader(cache_loader, num_batches=num_batches, num_warmup=num_workers)
+    logger.info("ImageFolder: %.1f images/sec" % folder_throughput)
+    logger.info("uint8 cache: %.1f images/sec (%.2fx)" % (cache_throughput, cache_throughput / folder_throughput))
+    return folder_throughput, cache_throughput
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data_dir", default="imagenet/val",
+                        help="ImageFolder-style eval set to cache.")
+    parser.add_argument("--cache_root", default="eval_cache",
+                        help="Caches are written to <cache_root>/<key of data_dir and transform>.")
+    parser.add_argument("--img_size", default=224, type=int)
+    parser.add_argument("--resize_size", default=None, type=int,
+                        help="Resize the short side to this and center crop --img_size (model_compare.py uses 256). "
+                        "By default images are resized to --img_size x --img_size as in train_vit.py.")
+    parser.add_argument("--num_workers", default=8, type=int)
+    parser.add_argument("--benchmark", action="store_true",
+                        help="Compare loader images/sec against decoding the JPEGs.")
+    args = parser.parse_args()
+
+    logging.basicConfig(format="%(asctime)s - %(levelname)s - %(name)s - %(message)s",
+                        datefmt='%m/%d/%Y %H:%M:%S',
+                        level=logging.INFO)
+
+    cache_dir = build_eval_cache(args.data_dir, args.cache_root, args.img_size, args.resize_size,
+                                 num_workers=args.num_workers)
+    logger.info("Eval cache: %s" % cache_dir)
+    if args.benchmark:
+        compare_loaders(args.data_dir, cache_dir, args.img_size, args.resize_size, num_workers=args.num_workers)
+
+if __name__ == "__main__":
+    main()
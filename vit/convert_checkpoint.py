@@ -0,0 +1,56 @@
+import argparse
+import logging
+import time
+
+import numpy as np
+import torch
+
+from vit_models import VisionTransformer, CONFIGS, convert_npz_checkpoint, build_pretrained
+
+logger = logging.getLogger(__name__)
+
+def benchmark_cold_start(config, npz_path, converted_path, img_size, num_classes):
+    """Times model construction plus weight loading for the `.npz` and the memory-mapped path."""
+    start_time = time.time()
+    model = VisionTransformer(config, img_size, num_classes=num_classes, zero_head=True)
+    model.load_from(np.load(npz_path))
+    npz_time = time.time() - start_time
+    del model
+
+    start_time = time.time()
+    model = build_pretrained(config, converted_path, img_size, num_classes=num_classes, zero_head=True)
+    # Touch every parameter once so that the mapped pages are actually read
+    with torch.no_grad():
+        sum(p.sum() for p in model.parameters())
+    mmap_time = time.time() - start_time
+
+    logger.info("Cold start with load_from(.npz): %.2fs" % npz_time)
+    logger.info("Cold start with memory-mapped checkpoint: %.2fs (%.1fx)" % (mmap_time, npz_time / mmap_time))
+    return npz_time, mmap_time
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--npz", required=True,
+                        help="JAX .npz checkpoint to convert.")
+    parser.add_argument("--output", required=True,
+                        help="Where to write the converted PyTorch checkpoint.")
+    parser.add_argument("--model_type", choices=list(CONFIGS.keys()), default="ViT-L_16",
+                        help="Which variant to use for --benchmark.")
+    parser.add_argument("--img_size", default=224, type=int,
+                        help="Resolution size for --benchmark.")
+    parser.add_argument("--num_classes", default=1000, type=int,
+                        help="Number of classes for --benchmark.")
+    parser.add_argument("--benchmark", action="store_true",
+                        help="Report cold start time before and after the conversion.")
+    args = parser.parse_args()
+
+    logging.basicConfig(format="%(asctime)s - %(levelname)s - %(name)s - %(message)s",
+                        datefmt='%m/%d/%Y %H:%M:%S',
+                        level=logging.INFO)
+
+    convert_npz_checkpoint(args.npz, args.output)
+    if args.benchmark:
+        benchmark_cold_start(CONFIGS[args.model_type], args.npz, args.output, args.img_size, args.num_classes)
+
+if __name__ == "__main__":
+    main()
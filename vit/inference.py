@@ -0,0 +1,144 @@
+import argparse
+import copy
+import logging
+import time
+
+import torch
+import torch.nn as nn
+
+from vit_models import VisionTransformer, CONFIGS
+
+logger = logging.getLogger(__name__)
+
+
+class LogitsOnly(nn.Module):
+    """Wraps a `VisionTransformer` so that forward returns only the logits tensor."""
+    def __init__(self, model):
+        super(LogitsOnly, self).__init__()
+        self.model = model
+
+    def forward(self, x):
+        return self.model(x)[0]
+
+
+class CompiledInference(object):
+    """
+    Compiled inference entry point for a `VisionTransformer`.
+    Inputs are padded up to the nearest of a fixed set of batch sizes, so the compiled graph
+    only ever sees a few static shapes; larger batches are split into chunks of the largest
+    bucket. `backend` is "compile" (torch.compile), "trace" (one TorchScript trace per bucket,
+    used when torch.compile is unavailable) or "eager". If compilation or a compiled call
+    fails, the wrapper logs a warning and falls back to eager mode for good.
+    The wrapper runs an eval-mode copy of `model`, so the caller's model keeps its mode and
+    later changes to it (e.g. further training) are not seen.
+    """
+    def __init__(self, model, batch_sizes=(1, 8, 32, 64), backend="compile", warmup=True):
+        self.eager = LogitsOnly(copy.deepcopy(model)).eval()
+        self.batch_sizes = sorted(batch_sizes)
+        param = next(model.parameters())
+        self.device, self.dtype = param.device, param.dtype
+        embeddings = model.transformer.embeddings
+        self.input_size = tuple(s * p for s, p in zip(embeddings.grid_size, embeddings.patch_embeddings.kernel_size))
+
+        if backend == "compile" and not hasattr(torch, "compile"):
+            logger.warning("torch.compile is not available, using TorchScript tracing")
+            backend = "trace"
+        self.backend = backend
+        self._traced = {}
+        self._compiled = None
+        try:
+            if backend == "compile":
+                self._compiled = torch.compile(self.eager, dynamic=False)
+            elif backend == "trace":
+                with torch.inference_mode():
+                    for batch_size in self.batch_sizes:
+                        self._traced[batch_size] = torch.jit.trace(self.eager, self._example(batch_size))
+            if warmup:
+                self.warmup()
+        except Exception as e:
+            self._fallback(e)
+
+    def _example(self, batch_size):
+        return torch.zeros(batch_size, 3, *self.input_size, device=self.device, dtype=self.dtype)
+
+    def _fallback(self, error):
+        logger.warning("Compiled inference failed (%s), falling back to eager mode" % error)
+        self.backend = "eager"
+        self._compiled = None
+        self._traced = {}
+
+    def warmup(self):
+        """Runs every bucket once so that compilation does not happen on the first real request."""
+        for batch_size in self.batch_sizes:
+            start_time = time.time()
+            self(self._example(batch_size))
+            logger.info("Warmup of batch size %d took %.2fs" % (batch_size, time.time() - start_time))
+
+    def _run_bucket(self, x, bucket):
+        if self.backend == "compile":
+            return self._compiled(x)
+        if self.backend == "trace":
+            return self._traced[bucket](x)
+        return self.eager(x)
+
+    def __call__(self, x):
+        x = x.to(self.device, self.dtype)
+        max_bucket = self.batch_sizes[-1]
+        if x.size(0) > max_bucket:
+            return torch.cat([self(chunk) for chunk in x.split(max_bucket)])
+
+        bucket = next(b for b in self.batch_sizes if b >= x.size(0))
+        padded = x
+        if bucket > x.size(0):
+            padded = torch.cat([x, x.new_zeros((bucket - x.size(0),) + x.shape[1:])])
+        with torch.inference_mode():
+            try:
+                logits = self._run_bucket(padded, bucket)
+            except Exception as e:
+                self._fallback(e)
+                logits = self.eager(padded)
+        return logits[:x.size(0)]
+
+
+def benchmark(model_types, batch_sizes, backends, img_size=224, num_iters=10, num_threads=None):
+    """CPU images/sec of eager vs. compiled inference per config and batch size."""
+    if num_threads is not None:
+        torch.set_num_threads(num_threads)
+    results = []
+    for model_type in model_types:
+        model = VisionTransformer(CONFIGS[model_type], img_size, num_classes=1000).eval()
+        for backend in backends:
+            runner = CompiledInference(model, batch_sizes=batch_sizes, backend=backend)
+            for batch_size in batch_sizes:
+                x = torch.randn(batch_size, 3, img_size, img_size)
+                runner(x)
+                start_time = time.time()
+                for _ in range(num_iters):
+                    runner(x)
+                images_per_sec = batch_size * num_iters / (time.time() - start_time)
+                results.append({"model_type": model_type, "backend": runner.backend,
+                                "batch_size": batch_size, "images_per_sec": images_per_sec})
+                logger.info("%-10s %-8s batch %3d: %8.1f images/sec" % (model_type, runner.backend, batch_size, images_per_sec))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model_types", nargs="+", default=["testing", "ViT-L_16", "ViT-H_14"],
+                        choices=list(CONFIGS.keys()))
+    parser.add_argument("--batch_sizes", nargs="+", type=int, default=[1, 8, 32])
+    parser.add_argument("--backends", nargs="+", default=["eager", "compile"],
+                        choices=["eager", "compile", "trace"])
+    parser.add_argument("--img_size", default=224, type=int)
+    parser.add_argument("--num_iters", default=10, type=int)
+    parser.add_argument("--num_threads", default=None, type=int)
+    args = parser.parse_args()
+
+    logging.basicConfig(format="%(asctime)s - %(levelname)s - %(name)s - %(message)s",
+                        datefmt='%m/%d/%Y %H:%M:%S',
+                        level=logging.INFO)
+    benchmark(args.model_types, args.batch_sizes, args.backends, args.img_size, args.num_iters, args.num_threads)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,248 @@
+import argparse
+import io
+import itertools
+import json
+import logging
+import os
+import resource
+import tarfile
+import time
+
+from collections import defaultdict
+
+import numpy as np
+
+from PIL import Image
+
+from make_shards import make_shards
+from utils.data_utils import get_loader, NORM_MEAN, NORM_STD
+
+logger = logging.getLogger(__name__)
+
+# Per-process stage timings, filled in the loader workers and shipped back with every batch
+_stage_times = defaultdict(float)
+_stage_counts = defaultdict(int)
+_last_sample_end = [None]
+
+def _add_stage(stage, seconds, count=1):
+    _stage_times[stage] += seconds
+    _stage_counts[stage] += count
+
+def timed_pil_loader(path):
+    """torchvision's PIL loader, timing the file read ("open") and the decode separately."""
+    start = time.perf_counter()
+    with open(path, 'rb') as f:
+        data = f.read()
+    opened = time.perf_counter()
+    img = Image.open(io.BytesIO(data)).convert('RGB')
+    _add_stage("open", opened - start)
+    _add_stage("decode", time.perf_counter() - opened)
+    return img
+
+class TimedTransform(object):
+    """
+    Times the dataset transform. With `measure_gap`, the time between the end of one
+    sample's transform and the start of the next within a batch is recorded as
+    "read+decode", for datasets that read and decode internally (tar, shards).
+    """
+    def __init__(self, transform, measure_gap):
+        self.transform = transform
+        self.measure_gap = measure_gap
+
+    def __call__(self, img):
+        start = time.perf_counter()
+        if self.measure_gap and _last_sample_end[0] is not None:
+            _add_stage("read+decode", start - _last_sample_end[0])
+        img = self.transform(img)
+        _last_sample_end[0] = time.perf_counter()
+        _add_stage("transform", _last_sample_end[0] - start)
+        return img
+
+class TimedCollate(object):
+    """Times the collate function and appends this worker's stage timings to the batch."""
+    def __init__(self, collate_fn):
+        self.collate_fn = collate_fn
+
+    def __call__(self, samples):
+        start = time.perf_counter()
+        batch = self.collate_fn(samples)
+        _add_stage("collate", time.perf_counter() - start, count=len(samples))
+        stats = {stage: (_stage_times[stage], _stage_counts[stage]) for stage in _stage_times}
+        _stage_times.clear()
+        _stage_counts.clear()
+        _last_sample_end[0] = None
+        return list(batch) + [stats]
+
+def make_fixtures(root, num_classes=10, images_per_class=64, num_val=8, seed=0, backends=("folder",)):
+    """
+    Writes synthetic JPEGs in the ImageNet layout: <root>/train/<wnid>/ and <root>/val/<wnid>/,
+    with ImageNet-like sizes (short side 300-500, aspect 3:4 to 4:3). For the tar and shards
+    backends also <root>/train.tar (one <wnid>.tar per class, like ILSVRC2012_img_train.tar)
+    and <root>/train_shards/. Existing fixtures are reused.
+    """
+    rng = np.random.RandomState(seed)
+    wnids = ["n%08d" % idx for idx in range(num_classes)]
+    for split, count in (("train", images_per_class), ("val", num_val)):
+        for wnid in wnids:
+            class_dir = os.path.join(root, split, wnid)
+            if os.path.isdir(class_dir):
+                continue
+            os.makedirs(class_dir)
+            for idx in range(count):
+                short = rng.randint(300, 501)
+                long = int(short * rng.uniform(1.0, 4.0 / 3.0))
+                width, height = (long, short) if rng.rand() < 0.5 else (short, long)
+                # Smooth gradients plus noise compress and decode roughly like photos
+                yy, xx = np.mgrid[0:height, 0:width]
+                base = np.stack([xx * 255 // width, yy * 255 // height, (xx + yy) * 127 // (width + height)], -1)
+                pixels = np.clip(base + rng.randint(0, 48, (height, width, 3)), 0, 255).astype(np.uint8)
+                Image.fromarray(pixels).save(os.path.join(class_dir, "%s_%d.JPEG" % (wnid, idx)), quality=90)
+
+    train_dir = os.path.join(root, "train")
+    tar_path = os.path.join(root, "train.tar")
+    if "tar" in backends and not os.path.exists(tar_path):
+        with tarfile.open(tar_path + ".tmp", "w") as outer:
+            for wnid in wnids:
+                class_tar = io.BytesIO()
+                with tarfile.open(fileobj=class_tar, mode="w") as inner:
+                    for name in sorted(os.listdir(os.path.join(train_dir, wnid))):
+                        inner.add(os.path.join(train_dir, wnid, name), arcname=name)
+                info = tarfile.TarInfo(wnid + ".tar")
+                info.size = class_tar.tell()
+                class_tar.seek(0)
+                outer.addfile(info, class_tar)
+        os.replace(tar_path + ".tmp", tar_path)
+    shard_dir = os.path.join(root, "train_shards")
+    if "shards" in backends and not os.path.exists(shard_dir):
+        make_shards(train_dir, shard_dir, num_shards=8, num_workers=4, seed=seed)
+    return root
+
+def loader_args(data_root, backend, batch_size, num_workers, pin_memory, persistent_workers, prefetch_factor,
+                img_size=224, train_tar=None, train_shards=None, seed=42):
+    """The arguments get_loader() reads, with train_vit.py's defaults for everything not swept."""
+    return argparse.Namespace(
+        data_root=data_root, data_backend=backend,
+        train_tar=train_tar or os.path.join(data_root, "train.tar"),
+        train_shards=train_shards or os.path.join(data_root, "train_shards"),
+        shuffle_buffer=1000, eval_cache=None, img_size=img_size,
+        norm_mean=list(NORM_MEAN), norm_std=list(NORM_STD), device_normalize=False, draft_decode=False,
+        num_workers=num_workers, prefetch_factor=prefetch_factor, persistent_workers=persistent_workers,
+        pin_memory=pin_memory, autotune_loader=False, local_rank=-1, seed=seed,
+        train_batch_size=batch_size, eval_batch_size=batch_size)
+
+def _cpu_seconds(who):
+    usage = resource.getrusage(who)
+    return usage.ru_utime + usage.ru_stime
+
+def run_point(args):
+    """Images/sec, worker CPU utilization and per-image stage times of one get_loader() configuration."""
+    train_loader, _ = get_loader(args)
+    dataset = train_loader.dataset
+    if args.data_backend == "folder":
+        dataset.loader = timed_pil_loader
+    dataset.transform = TimedTransform(dataset.transform, measure_gap=args.data_backend != "folder")
+    train_loader.collate_fn = TimedCollate(train_loader.collate_fn)
+
+    cpu_who = resource.RUSAGE_CHILDREN if args.num_workers > 0 else resource.RUSAGE_SELF
+    cpu_start, wall_start = _cpu_seconds(cpu_who), time.perf_counter()
+    iterator = iter(train_loader)
+    first_batch_s = None
+    stage_times, stage_counts = defaultdict(float), defaultdict(int)
+    num_images, measure_start = 0, wall_start
+    for idx in range(args.num_warmup + args.num_batches):
+        try:
+            batch = next(iterator)
+        except StopIteration:
+            break
+        if first_batch_s is None:
+            first_batch_s = time.perf_counter() - wall_start
+        if idx < args.num_warmup:
+            measure_start = time.perf_counter()
+            continue
+        num_images += batch[0].size(0)
+        for stage, (seconds, count) in batch[-1].items():
+            stage_times[stage] += seconds
+            stage_counts[stage] += count
+    elapsed = time.perf_counter() - measure_start
+    del iterator
+
+    # A second epoch shows the worker startup that persistent_workers avoids
+    restart_start = time.perf_counter()
+    next(iter(train_loader))
+    restart_s = time.perf_counter() - restart_start
+
+    # Shut the workers down so that their CPU time is accounted to RUSAGE_CHILDREN
+    if getattr(train_loader, "_iterator", None) is not None:
+        train_loader._iterator._shutdown_workers()
+    del train_loader
+    wall = time.perf_counter() - wall_start
+    cpu = _cpu_seconds(cpu_who) - cpu_start
+
+    return {
+        "images_per_sec": num_images / elapsed if elapsed > 0 else 0.0,
+        "first_batch_s": first_batch_s,
+        "restart_s": restart_s,
+        "worker_cpu_utilization": cpu / (wall * max(args.num_workers, 1)),
+        "stage_ms_per_image": {stage: stage_times[stage] / max(stage_counts[stage], 1) * 1000.0
+                               for stage in sorted(stage_times)},
+    }
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data_root", default=None, type=str,
+                        help="Dataset root as in train_vit.py. By default synthetic JPEG fixtures are written to "
+                        "--fixtures_dir and used, so the benchmark runs without ImageNet.")
+    parser.add_argument("--train_tar", default=None, type=str,
+                        help="Train tar for the tar backend (default <data_root>/train.tar).")
+    parser.add_argument("--train_shards", default=None, type=str,
+                        help="Shard directory for the shards backend (default <data_root>/train_shards).")
+    parser.add_argument("--fixtures_dir", default="loader_fixtures", type=str)
+    parser.add_argument("--num_classes", default=10, type=int, help="Fixture classes.")
+    parser.add_argument("--images_per_class", default=64, type=int, help="Fixture train images per class.")
+    parser.add_argument("--backends", nargs="+", default=["folder"], choices=["folder", "tar", "shards"])
+    parser.add_argument("--num_workers", nargs="+", type=int, default=[0, 2, 4])
+    parser.add_argument("--batch_sizes", nargs="+", type=int, default=[64])
+    parser.add_argument("--pin_memory", nargs="+", type=int, default=[1], choices=[0, 1])
+    parser.add_argument("--persistent_workers", nargs="+", type=int, default=[0], choices=[0, 1])
+    parser.add_argument("--prefetch_factors", nargs="+", type=int, default=[2])
+    parser.add_argument("--img_size", default=224, type=int)
+    parser.add_argument("--num_batches", default=8, type=int, help="Measured batches per configuration.")
+    parser.add_argument("--num_warmup", default=2, type=int, help="Batches excluded from the measurement.")
+    parser.add_argument("--output", default="loader_benchmark.json", type=str)
+    args = parser.parse_args()
+
+    logging.basicConfig(format="%(asctime)s - %(levelname)s - %(name)s - %(message)s",
+                        datefmt='%m/%d/%Y %H:%M:%S',
+                        level=logging.INFO)
+
+    data_root = args.data_root
+    if data_root is None:
+        data_root = make_fixtures(args.fixtures_dir, args.num_classes, args.images_per_class, backends=args.backends)
+
+    results = []
+    for backend, batch_size, num_workers, pin_memory, persistent_workers, prefetch_factor in itertools.product(
+            args.backends, args.batch_sizes, args.num_workers, args.pin_memory, args.persistent_workers,
+            args.prefetch_factors):
+        if num_workers == 0 and (persistent_workers or prefetch_factor != args.prefetch_factors[0]):
+            # Both only apply to worker processes
+            continue
+        point_args = loader_args(data_root, backend, batch_size, num_workers, bool(pin_memory),
+                                 bool(persistent_workers), prefetch_factor, args.img_size,
+                                 args.train_tar, args.train_shards)
+        point_args.num_batches, point_args.num_warmup = args.num_batches, args.num_warmup
+        result = dict(backend=backend, batch_size=batch_size, num_workers=num_workers, pin_memory=bool(pin_memory),
+                      persistent_workers=bool(persistent_workers), prefetch_factor=prefetch_factor,
+                      **run_point(point_args))
+        results.append(result)
+        logger.info("%-6s bs %3d workers %2d pin %d persistent %d prefetch %d: %7.1f images/s, "
+                    "worker CPU %3.0f%%, restart %.2fs, ms/image %s"
+                    % (backend, batch_size, num_workers, pin_memory, persistent_workers, prefetch_factor,
+                       result["images_per_sec"], result["worker_cpu_utilization"] * 100, result["restart_s"],
+                       ", ".join("%s %.2f" % item for item in result["stage_ms_per_image"].items())))
+
+    with open(args.output, "w") as f:
+        json.dump({"data_root": data_root, "cpu_count": os.cpu_count(), "results": results}, f, indent=2)
+    logger.info("Wrote %d results to %s" % (len(results), args.output))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+import argparse
+import json
+import logging
+import os
+import random
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+from torch.utils.data import DataLoader, RandomSampler
+from torchvision import datasets
+
+from utils.data_utils import benchmark_loader, get_transforms
+from utils.shard_dataset import ShardedImageDataset, SHARD_INDEX, write_shard
+from utils.tar_dataset import IMG_EXTENSIONS
+
+logger = logging.getLogger(__name__)
+
+def list_image_folder(data_dir):
+    """[(path, label)] of an ImageFolder-style directory, with classes numbered in sorted order."""
+    classes = sorted(entry.name for entry in os.scandir(data_dir) if entry.is_dir())
+    samples = []
+    for label, wnid in enumerate(classes):
+        class_dir = os.path.join(data_dir, wnid)
+        for name in sorted(os.listdir(class_dir)):
+            if name.lower().endswith(IMG_EXTENSIONS):
+                samples.append((os.path.join(class_dir, name), label))
+    return samples, classes
+
+def make_shards(data_dir, output_dir, num_shards=256, num_workers=8, seed=0):
+    """
+    Packs an ImageFolder-style directory into `num_shards` tar shards plus a shards.json index.
+    Samples are shuffled globally first, so that every shard holds a mix of all classes.
+    """
+    samples, classes = list_image_folder(data_dir)
+    random.Random(seed).shuffle(samples)
+    os.makedirs(output_dir, exist_ok=True)
+
+    bounds = [len(samples) * i // num_shards for i in range(num_shards + 1)]
+    names = ["shard_%05d.tar" % i for i in range(num_shards)]
+    start_time = time.time()
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        futures = [executor.submit(write_shard, os.path.join(output_dir, names[i]),
+                                   samples[bounds[i]:bounds[i + 1]], bounds[i])
+                   for i in range(num_shards)]
+        for done, future in enumerate(futures, 1):
+            future.result()
+            if done % 16 == 0 or done == num_shards:
+                logger.info("Wrote %d/%d shards (%.0f images/s)" %
+                            (done, num_shards, bounds[done] / (time.time() - start_time)))
+
+    with open(os.path.join(output_dir, SHARD_INDEX), "w") as f:
+        json.dump({"shards": names,
+                   "sizes": [bounds[i + 1] - bounds[i] for i in range(num_shards)],
+                   "classes": classes}, f)
+    logger.info("Packed %d images in %d classes into %d shards in %s" %
+                (len(samples), len(classes), num_shards, output_dir))
+
+def compare_loaders(data_dir, shard_dir, img_size=224, batch_size=128, num_workers=8, num_batches=50):
+    """Loader images/sec of ImageFolder with a RandomSampler against the shards, on the same transforms."""
+    transform_train = get_transforms(img_size)[0]
+    folder = datasets.ImageFolder(data_dir, transform=transform_train)
+    folder_loader = DataLoader(folder, sampler=RandomSampler(folder), batch_size=batch_size,
+                               num_workers=num_workers, pin_memory=True)
+    shards = ShardedImageDataset(shard_dir, transform=transform_train)
+    shard_loader = DataLoader(shards, batch_size=batch_size, num_workers=num_workers, pin_memory=True)
+
+    folder_throughput = benchmark_loader(folder_loader, num_batches=num_batches, num_warmup=num_workers)
+    shard_throughput = benchmark_loader(shard_loader, num_batches=num_batches, num_warmup=num_workers)
+    logger.info("ImageFolder: %.1f images/sec" % folder_throughput)
+    logger.info("Shards:      %.1f images/sec (%.2fx)" % (shard_throughput, shard_throughput / folder_throughput))
+    return folder_throughput, shard_throughput
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data_dir", default="imagenet/train",
+                        help="ImageFolder-style directory to pack.")
+    parser.add_argument("--output_dir", default="imagenet/train_shards",
+                        help="Where to write the shards and shards.json.")
+    parser.add_argument("--num_shards", default=256, type=int,
+                        help="Number of shards; ImageNet train gives ~550 MB per shard at 256.")
+    parser.add_argument("--num_workers", default=8, type=int,
+                        help="Shards written in parallel, and loader workers for --benchmark.")
+    parser.add_argument("--seed", default=0, type=int)
+    parser.add_argument("--benchmark", action="store_true",
+                        help="Compare loader images/sec against ImageFolder on the same disk.")
+    parser.add_argument("--skip_packing", action="store_true",
+                        help="Only run --benchmark on existing shards.")
+    args = parser.parse_args()
+
+    logging.basicConfig(format="%(asctime)s - %(levelname)s - %(name)s - %(message)s",
+                        datefmt='%m/%d/%Y %H:%M:%S',
+                        level=logging.INFO)
+
+    if not args.skip_packing:
+        make_shards(args.data_dir, args.output_dir, args.num_shards, args.num_workers, args.seed)
+    if args.benchmark:
+        compare_loaders(args.data_dir, args.output_dir, num_workers=args.num_workers)
+
+if __name__ == "__main__":
+    main()
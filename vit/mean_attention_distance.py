@@ -0,0 +1,171 @@
+import argparse
+import functools
+import json
+import logging
+
+import numpy as np
+import torch
+import torchvision.models as models
+
+from torchvision import transforms, datasets
+from torch.utils.data import DataLoader, Subset
+from tqdm import tqdm
+
+from attention_stats import AttentionReducer, accumulate_attention_stats
+from utils.data_utils import NORM_MEAN, NORM_STD, IMAGENET_MEAN, IMAGENET_STD
+from vit_models import VisionTransformer, CONFIGS
+
+logger = logging.getLogger(__name__)
+
+
+@functools.lru_cache(maxsize=None)
+def distance_matrix(patch_size, grid, num_cls_tokens=1, device="cpu"):
+    """
+    Pixel distances between all pairs of tokens of a `grid` of patches, as an (N, N) tensor
+    with N = num_cls_tokens + grid[0] * grid[1]. Rows and columns of the class tokens are zero,
+    so the matrix can be contracted with the full attention tensor without slicing it.
+    """
+    rows = torch.arange(grid[0]).repeat_interleave(grid[1])
+    cols = torch.arange(grid[1]).repeat(grid[0])
+    coords = torch.stack((rows, cols), dim=-1).float()
+    num_tokens = num_cls_tokens + grid[0] * grid[1]
+    distances = torch.zeros(num_tokens, num_tokens)
+    distances[num_cls_tokens:, num_cls_tokens:] = patch_size * torch.cdist(coords, coords)
+    return distances.to(device)
+
+
+def mean_attention_distance(attention_probs, patch_size, num_cls_tokens=1, grid=None):
+    """
+    Mean attention distance per sample and head, (B, H, N, N) -> (B, H).
+    For every patch query token the attention-weighted distance to the patch key tokens is
+    summed, and then averaged over the query tokens, as one batched contraction.
+    """
+    num_patches = attention_probs.size(-1) - num_cls_tokens
+    if grid is None:
+        length = int(round(num_patches ** 0.5))
+        assert length ** 2 == num_patches, "Num patches is not perfect square"
+        grid = (length, length)
+    distances = distance_matrix(patch_size, tuple(grid), num_cls_tokens, attention_probs.device)
+    distances = distances.to(attention_probs.dtype)
+    return torch.einsum("bhij,ij->bh", attention_probs, distances) / num_patches
+
+
+class MeanAttentionDistance(AttentionReducer):
+    """Running mean attention distance in pixels per layer and head (Raghu et al., 2021)."""
+    def __init__(self, patch_size, num_cls_tokens=1, grid=None):
+        self.patch_size = patch_size
+        self.num_cls_tokens = num_cls_tokens
+        self.grid = grid
+        super(MeanAttentionDistance, self).__init__()
+
+    def reduce(self, attention_probs):
+        return mean_attention_distance(attention_probs, self.patch_size, self.num_cls_tokens, self.grid)
+
+
+def attach_torchvision_reducer(model, reducer, layers=None):
+    """
+    Feeds the per-head attention probabilities of a torchvision `VisionTransformer` to `reducer`.
+    Its encoder layers call `nn.MultiheadAttention` with `need_weights=False`, so a pre-hook
+    turns the weights on for the same forward pass. `layers` restricts the hooks to these
+    encoder layer indices (default all). Returns the hook handles.
+    """
+    def force_weights(module, args, kwargs):
+        kwargs["need_weights"] = True
+        kwargs["average_attn_weights"] = False
+        return args, kwargs
+
+    def forward_hook(layer_idx, module, args, output):
+        reducer.update(layer_idx, output[1].detach())
+
+    handles = []
+    for layer_idx, encoder_layer in enumerate(model.encoder.layers):
+        if layers is not None and layer_idx not in layers:
+            continue
+        attention = encoder_layer.self_attention
+        handles.append(attention.register_forward_pre_hook(force_weights, with_kwargs=True))
+        handles.append(attention.register_forward_hook(functools.partial(forward_hook, layer_idx)))
+    return handles
+
+
+def compute_mean_attention_distances(model, loader, patch_size=None, num_cls_tokens=1, device="cpu"):
+    """
+    Streams `loader` through `model` and returns {layer index: (H,) mean attention distance}.
+    Works with our `VisionTransformer` (with or without vis=True) and torchvision ViTs.
+    """
+    if isinstance(model, VisionTransformer):
+        if patch_size is None:
+            patch_size = model.transformer.embeddings.patch_embeddings.kernel_size[0]
+        reducer = MeanAttentionDistance(patch_size, num_cls_tokens)
+        accumulate_attention_stats(model, loader, [reducer], device)
+        return reducer.result()
+
+    if patch_size is None:
+        patch_size = model.patch_size
+    reducer = MeanAttentionDistance(patch_size, num_cls_tokens)
+    handles = attach_torchvision_reducer(model, reducer)
+    model.eval()
+    try:
+        with torch.no_grad():
+            for x, *_ in tqdm(loader, desc="Computing mean attention distance"):
+                model(x.to(device))
+    finally:
+        for handle in handles:
+            handle.remove()
+    return reducer.result()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", default="vit_b_16",
+                        help="torchvision ViT architecture (e.g. vit_b_16) or one of %s." % ", ".join(CONFIGS))
+    parser.add_argument("--checkpoint", default=None, type=str,
+                        help="State dict to load, e.g. a %%s_checkpoint.bin written by train_vit.py.")
+    parser.add_argument("--data_dir", default="imagenet/val", type=str,
+                        help="ImageFolder directory to compute the distances over.")
+    parser.add_argument("--num_images", default=None, type=int,
+                        help="Use a random subset of this many images instead of the whole set.")
+    parser.add_argument("--img_size", default=224, type=int)
+    parser.add_argument("--batch_size", default=64, type=int)
+    parser.add_argument("--norm_mean", nargs=3, type=float, default=None,
+                        help="Per-channel mean the model was trained with (default 0.5 for our ViT, "
+                        "the ImageNet statistics for torchvision models).")
+    parser.add_argument("--norm_std", nargs=3, type=float, default=None,
+                        help="Per-channel std the model was trained with (default as --norm_mean).")
+    parser.add_argument("--num_workers", default=4, type=int)
+    parser.add_argument("--output", default="mean_attention_distance.json", type=str)
+    args = parser.parse_args()
+
+    logging.basicConfig(format="%(asctime)s - %(levelname)s - %(name)s - %(message)s",
+                        datefmt='%m/%d/%Y %H:%M:%S',
+                        level=logging.INFO)
+
+    if args.model in CONFIGS:
+        model = VisionTransformer(CONFIGS[args.model], args.img_size, num_classes=1000)
+        normalize = transforms.Normalize(mean=args.norm_mean or NORM_MEAN, std=args.norm_std or NORM_STD)
+    else:
+        model = models.__dict__[args.model]()
+        normalize = transforms.Normalize(mean=args.norm_mean or IMAGENET_MEAN, std=args.norm_std or IMAGENET_STD)
+    if args.checkpoint is not None:
+        state_dict = torch.load(args.checkpoint, map_location="cpu")
+        model.load_state_dict({k.replace('module.', ''): v for k, v in state_dict.items()})
+
+    dataset = datasets.ImageFolder(args.data_dir, transforms.Compose([
+        transforms.Resize(int(args.img_size * 256 / 224)),
+        transforms.CenterCrop(args.img_size),
+        transforms.ToTensor(),
+        normalize,
+    ]))
+    if args.num_images is not None:
+        dataset = Subset(dataset, np.random.choice(len(dataset), args.num_images, replace=False))
+    loader = DataLoader(dataset, batch_size=args.batch_size, shuffle=False, num_workers=args.num_workers)
+
+    distances = compute_mean_attention_distances(model, loader)
+    with open(args.output, "w") as f:
+        json.dump({"model": args.model,
+                   "num_images": len(dataset),
+                   "mean_distances": {str(k): v.tolist() for k, v in distances.items()}}, f, indent=2)
+    logger.info("Wrote mean attention distances for %d layers to %s" % (len(distances), args.output))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+import argparse
+import logging
+import time
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torchvision.models as models
+
+from torchvision import transforms, datasets
+from torch.utils.data import DataLoader, Subset
+
+from utils.data_utils import NORM_MEAN, NORM_STD, IMAGENET_MEAN, IMAGENET_STD
+from vit_models import VisionTransformer, CONFIGS
+
+logger = logging.getLogger(__name__)
+
+
+def quantize_model(model):
+    """
+    INT8 dynamic quantization of every `nn.Linear` for CPU inference: weights are stored as
+    int8 and activations are quantized on the fly. For our `VisionTransformer` this covers the
+    query/key/value/out projections of `Attention`, both layers of `Mlp` and the head. In
+    torchvision ViTs the fused attention in-projection is not an `nn.Linear`, so only the MLP
+    blocks and the head are quantized.
+    """
+    return torch.ao.quantization.quantize_dynamic(model.eval(), {nn.Linear}, dtype=torch.qint8)
+
+
+def load_fp32_model(model, checkpoint=None, img_size=224, num_classes=1000):
+    """`model` is a key of CONFIGS (our ViT) or a torchvision architecture name such as vit_b_16."""
+    if model in CONFIGS:
+        net = VisionTransformer(CONFIGS[model], img_size, num_classes=num_classes)
+    else:
+        net = models.__dict__[model]()
+    if checkpoint is not None:
+        state_dict = torch.load(checkpoint, map_location="cpu")
+        net.load_state_dict({k.replace('module.', ''): v for k, v in state_dict.items()})
+    return net.eval()
+
+
+def get_logits(model, x):
+    output = model(x)
+    return output[0] if isinstance(output, tuple) else output
+
+
+def evaluate_top1(model, loader):
+    correct, total = 0, 0
+    with torch.inference_mode():
+        for x, y in loader:
+            preds = get_logits(model, x).argmax(dim=-1)
+            correct += (preds == y).sum().item()
+            total += y.size(0)
+    return 100.0 * correct / total
+
+
+def time_forward(model, batch_size=32, img_size=224, num_iters=10):
+    x = torch.randn(batch_size, 3, img_size, img_size)
+    with torch.inference_mode():
+        get_logits(model, x)
+        start_time = time.time()
+        for _ in range(num_iters):
+            get_logits(model, x)
+    return (time.time() - start_time) / num_iters
+
+
+def get_val_loader(model, data_dir, num_images, img_size=224, batch_size=64, num_workers=4, seed=0,
+                   mean=None, std=None):
+    """
+    Fixed random subset of the validation set with the preprocessing the model was trained with.
+    `mean`/`std` default to train_vit.py's for our ViT and to the ImageNet statistics otherwise.
+    """
+    if model in CONFIGS:
+        normalize = transforms.Normalize(mean=mean or NORM_MEAN, std=std or NORM_STD)
+        transform = transforms.Compose([transforms.Resize((img_size, img_size)), transforms.ToTensor(), normalize])
+    else:
+        normalize = transforms.Normalize(mean=mean or IMAGENET_MEAN, std=std or IMAGENET_STD)
+        transform = transforms.Compose([transforms.Resize(256), transforms.CenterCrop(img_size),
+                                        transforms.ToTensor(), normalize])
+    dataset = datasets.ImageFolder(data_dir, transform)
+    indices = np.random.RandomState(seed).choice(len(dataset), min(num_images, len(dataset)), replace=False)
+    return DataLoader(Subset(dataset, indices), batch_size=batch_size, shuffle=False, num_workers=num_workers)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", default="ViT-L_16",
+                        help="One of %s, or a torchvision architecture such as vit_b_16." % ", ".join(CONFIGS))
+    parser.add_argument("--checkpoint", default=None, type=str,
+                        help="fp32 state dict, e.g. a %%s_checkpoint.bin written by train_vit.py.")
+    parser.add_argument("--data_dir", default="imagenet/val", type=str)
+    parser.add_argument("--num_images", default=5000, type=int,
+                        help="Size of the validation subset used for the top-1 comparison.")
+    parser.add_argument("--img_size", default=224, type=int)
+    parser.add_argument("--batch_size", default=64, type=int)
+    parser.add_argument("--norm_mean", nargs=3, type=float, default=None,
+                        help="Per-channel mean the model was trained with (default 0.5 for our ViT, "
+                        "the ImageNet statistics for torchvision models).")
+    parser.add_argument("--norm_std", nargs=3, type=float, default=None,
+                        help="Per-channel std the model was trained with (default as --norm_mean).")
+    parser.add_argument("--num_threads", default=None, type=int)
+    parser.add_argument("--output", default=None, type=str,
+                        help="Optionally save the quantized model here (torch.save of the whole module).")
+    args = parser.parse_args()
+
+    logging.basicConfig(format="%(asctime)s - %(levelname)s - %(name)s - %(message)s",
+                        datefmt='%m/%d/%Y %H:%M:%S',
+                        level=logging.INFO)
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+
+    fp32_model = load_fp32_model(args.model, args.checkpoint, args.img_size)
+    int8_model = quantize_model(load_fp32_model(args.model, args.checkpoint, args.img_size))
+
+    fp32_time = time_forward(fp32_model, args.batch_size, args.img_size)
+    int8_time = time_forward(int8_model, args.batch_size, args.img_size)
+    logger.info("fp32: %.1f images/sec, int8: %.1f images/sec, speedup %.2fx"
+                % (args.batch_size / fp32_time, args.batch_size / int8_time, fp32_time / int8_time))
+
+    loader = get_val_loader(args.model, args.data_dir, args.num_images, args.img_size, args.batch_size,
+                            mean=args.norm_mean, std=args.norm_std)
+    fp32_acc = evaluate_top1(fp32_model, loader)
+    int8_acc = evaluate_top1(int8_model, loader)
+    logger.info("Top-1 on %d images: fp32 %.2f%%, int8 %.2f%% (delta %+.2f)"
+                % (len(loader.dataset), fp32_acc, int8_acc, int8_acc - fp32_acc))
+
+    if args.output is not None:
+        torch.save(int8_model, args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,230 @@
+import argparse
+import io
+import json
+import logging
+import queue
+import threading
+import time
+
+from collections import deque
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import torch
+
+from PIL import Image
+from torchvision import transforms
+
+from utils.data_utils import NORM_MEAN, NORM_STD
+from vit_models import VisionTransformer, CONFIGS
+from inference import CompiledInference
+
+logger = logging.getLogger(__name__)
+
+
+class DynamicBatcher(object):
+    """
+    Queues single-sample requests and runs them through `predict_fn` in dynamic batches.
+    A worker thread takes the first queued request and keeps collecting until the batch
+    holds `max_batch_size` samples or `max_wait_ms` have passed since that first request.
+    If a batch fails, the exception is set on the Future of every request in it.
+    """
+    def __init__(self, predict_fn, max_batch_size=32, max_wait_ms=5.0, num_workers=1, window=10000):
+        self.predict_fn = predict_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._latencies = deque(maxlen=window)
+        self._batch_sizes = deque(maxlen=window)
+        self._num_done = 0
+        self._start_time = time.time()
+        self._running = True
+        self._workers = [threading.Thread(target=self._worker, daemon=True) for _ in range(num_workers)]
+        for worker in self._workers:
+            worker.start()
+
+    def submit(self, x):
+        """Queues one (C, H, W) input and returns a Future for its prediction."""
+        future = Future()
+        self._queue.put((x, future, time.time()))
+        return future
+
+    def _collect(self):
+        first = self._queue.get()
+        if first is None:
+            return None
+        batch = [first]
+        deadline = first[2] + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if item is None:
+                self._queue.put(None)
+                break
+            batch.append(item)
+        return batch
+
+    def _worker(self):
+        while self._running:
+            batch = self._collect()
+            if batch is None:
+                break
+            try:
+                inputs = torch.stack([x for x, _, _ in batch])
+                with torch.inference_mode():
+                    outputs = self.predict_fn(inputs)
+            except Exception as e:
+                # Fail every request of the batch, so that no caller waits forever
+                logger.exception("Batch of %d failed" % len(batch))
+                for _, future, _ in batch:
+                    future.set_exception(e)
+                continue
+            done_time = time.time()
+            for i, (_, future, submit_time) in enumerate(batch):
+                future.set_result(outputs[i])
+            with self._lock:
+                self._latencies.extend(done_time - submit_time for _, _, submit_time in batch)
+                self._batch_sizes.append(len(batch))
+                self._num_done += len(batch)
+
+    def stats(self):
+        with self._lock:
+            latencies = np.array(self._latencies) * 1000.0
+            batch_sizes = np.array(self._batch_sizes)
+            num_done = self._num_done
+        elapsed = time.time() - self._start_time
+        return {
+            "requests": num_done,
+            "throughput": num_done / elapsed if elapsed > 0 else 0.0,
+            "p50_ms": float(np.percentile(latencies, 50)) if len(latencies) else None,
+            "p99_ms": float(np.percentile(latencies, 99)) if len(latencies) else None,
+            "mean_batch_size": float(batch_sizes.mean()) if len(batch_sizes) else None,
+        }
+
+    def close(self):
+        self._running = False
+        for _ in self._workers:
+            self._queue.put(None)
+        for worker in self._workers:
+            worker.join()
+
+
+def load_model(model_type, checkpoint, img_size=224, num_classes=1000):
+    """Builds a `VisionTransformer` from a `%s_checkpoint.bin` state dict written by train_vit.save_model."""
+    model = VisionTransformer(CONFIGS[model_type], img_size, num_classes=num_classes)
+    state_dict = torch.load(checkpoint, map_location="cpu")
+    model.load_state_dict({k.replace('module.', ''): v for k, v in state_dict.items()})
+    return model.eval()
+
+
+def make_handler(batcher, transform, topk):
+    class InferenceHandler(BaseHTTPRequestHandler):
+        def _send_json(self, status, payload):
+            body = json.dumps(payload).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == "/stats":
+                self._send_json(200, batcher.stats())
+            else:
+                self._send_json(404, {"error": "unknown path %s" % self.path})
+
+        def do_POST(self):
+            if self.path != "/predict":
+                self._send_json(404, {"error": "unknown path %s" % self.path})
+                return
+            try:
+                data = self.rfile.read(int(self.headers["Content-Length"]))
+                x = transform(Image.open(io.BytesIO(data)).convert("RGB"))
+            except Exception as e:
+                self._send_json(400, {"error": "could not decode image: %s" % e})
+                return
+            try:
+                probs = batcher.submit(x).result()
+            except Exception as e:
+                self._send_json(500, {"error": "inference failed: %s" % e})
+                return
+            values, indices = probs.topk(topk)
+            self._send_json(200, {"classes": indices.tolist(), "probs": values.tolist()})
+
+        def log_message(self, format, *args):
+            logger.debug(format % args)
+
+    return InferenceHandler
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--checkpoint", required=True,
+                        help="%%s_checkpoint.bin written by train_vit.py.")
+    parser.add_argument("--model_type", choices=list(CONFIGS.keys()), default="ViT-L_16")
+    parser.add_argument("--img_size", default=224, type=int)
+    parser.add_argument("--num_classes", default=1000, type=int)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", default=8080, type=int)
+    parser.add_argument("--max_batch_size", default=32, type=int,
+                        help="Largest dynamic batch.")
+    parser.add_argument("--max_wait_ms", default=5.0, type=float,
+                        help="Longest time the first request of a batch waits for more requests.")
+    parser.add_argument("--num_workers", default=1, type=int,
+                        help="Inference worker threads.")
+    parser.add_argument("--num_threads", default=None, type=int,
+                        help="torch intra-op threads (shared by all workers).")
+    parser.add_argument("--compile", action="store_true",
+                        help="Run the model through inference.CompiledInference.")
+    parser.add_argument("--topk", default=5, type=int)
+    parser.add_argument("--norm_mean", nargs=3, type=float, default=list(NORM_MEAN),
+                        help="Per-channel mean the model was trained with (train_vit.py's --norm_mean).")
+    parser.add_argument("--norm_std", nargs=3, type=float, default=list(NORM_STD),
+                        help="Per-channel std the model was trained with (train_vit.py's --norm_std).")
+    args = parser.parse_args()
+
+    logging.basicConfig(format="%(asctime)s - %(levelname)s - %(name)s - %(message)s",
+                        datefmt='%m/%d/%Y %H:%M:%S',
+                        level=logging.INFO)
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+
+    model = load_model(args.model_type, args.checkpoint, args.img_size, args.num_classes)
+    if args.compile:
+        buckets = sorted({b for b in (1, 4, 8, 16) if b < args.max_batch_size} | {args.max_batch_size})
+        runner = CompiledInference(model, batch_sizes=buckets)
+        # CompiledInference runs its own copy of the weights
+        del model
+    else:
+        runner = lambda x: model(x)[0]
+
+    def predict(x):
+        return torch.softmax(runner(x), dim=-1)
+
+    transform = transforms.Compose([
+        transforms.Resize((args.img_size, args.img_size)),
+        transforms.ToTensor(),
+        transforms.Normalize(mean=args.norm_mean, std=args.norm_std),
+    ])
+    batcher = DynamicBatcher(predict, args.max_batch_size, args.max_wait_ms, args.num_workers)
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(batcher, transform, args.topk))
+    logger.info("Serving %s on http://%s:%d (POST /predict, GET /stats)" % (args.model_type, args.host, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        batcher.close()
+        logger.info("Final stats: %s" % json.dumps(batcher.stats()))
+
+
+if __name__ == "__main__":
+    main()
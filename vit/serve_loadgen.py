@@ -0,0 +1,100 @@
+import argparse
+import io
+import json
+import logging
+import os
+import threading
+import time
+import urllib.request
+
+import numpy as np
+
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+def synthetic_jpeg(size=(500, 375), seed=0):
+    """A random-noise JPEG roughly the size of an ImageNet image."""
+    rng = np.random.RandomState(seed)
+    image = Image.fromarray(rng.randint(0, 256, (size[1], size[0], 3), dtype=np.uint8))
+    buf = io.BytesIO()
+    image.save(buf, format="JPEG", quality=90)
+    return buf.getvalue()
+
+
+def load_payloads(image_dir, limit=64):
+    if image_dir is None:
+        return [synthetic_jpeg(seed=i) for i in range(8)]
+    names = sorted(os.listdir(image_dir))[:limit]
+    payloads = []
+    for name in names:
+        with open(os.path.join(image_dir, name), "rb") as f:
+            payloads.append(f.read())
+    return payloads
+
+
+def client(url, payloads, num_requests, latencies, errors, lock, offset):
+    for i in range(num_requests):
+        data = payloads[(offset + i) % len(payloads)]
+        request = urllib.request.Request(url + "/predict", data=data, headers={"Content-Type": "image/jpeg"})
+        start = time.time()
+        try:
+            with urllib.request.urlopen(request) as response:
+                response.read()
+        except Exception:
+            with lock:
+                errors.append(i)
+            continue
+        with lock:
+            latencies.append(time.time() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", default="http://127.0.0.1:8080")
+    parser.add_argument("--concurrency", default=16, type=int,
+                        help="Number of concurrent clients, each sending one image at a time.")
+    parser.add_argument("--requests_per_client", default=50, type=int)
+    parser.add_argument("--image_dir", default=None, type=str,
+                        help="Directory of JPEGs to send. Random-noise JPEGs are used if not given.")
+    parser.add_argument("--output", default=None, type=str,
+                        help="Also write the client-side results and the server stats to this JSON file.")
+    args = parser.parse_args()
+
+    logging.basicConfig(format="%(asctime)s - %(levelname)s - %(name)s - %(message)s",
+                        datefmt='%m/%d/%Y %H:%M:%S',
+                        level=logging.INFO)
+
+    payloads = load_payloads(args.image_dir)
+    latencies, errors, lock = [], [], threading.Lock()
+    threads = [threading.Thread(target=client,
+                                args=(args.url, payloads, args.requests_per_client, latencies, errors, lock, i))
+               for i in range(args.concurrency)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+
+    latencies = np.array(latencies) * 1000.0
+    report = {"concurrency": args.concurrency, "requests": len(latencies), "failed": len(errors),
+              "elapsed_s": elapsed, "throughput": len(latencies) / elapsed if elapsed > 0 else 0.0,
+              "p50_ms": float(np.percentile(latencies, 50)) if len(latencies) else None,
+              "p99_ms": float(np.percentile(latencies, 99)) if len(latencies) else None}
+    logger.info("Requests: %d ok, %d failed in %.1fs" % (len(latencies), len(errors), elapsed))
+    if len(latencies):
+        logger.info("Throughput: %.1f images/sec" % report["throughput"])
+        logger.info("Latency p50: %.1f ms, p99: %.1f ms" % (report["p50_ms"], report["p99_ms"]))
+    with urllib.request.urlopen(args.url + "/stats") as response:
+        report["server"] = json.loads(response.read())
+    logger.info("Server stats: %s" % json.dumps(report["server"]))
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        logger.info("Wrote %s" % args.output)
+
+
+if __name__ == "__main__":
+    main()
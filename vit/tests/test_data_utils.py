@@ -0,0 +1,73 @@
+import os
+import sys
+
+import numpy as np
+import torch
+
+from PIL import Image
+from torch.utils.data import DataLoader, Dataset, IterableDataset, TensorDataset
+from torchvision import transforms
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from utils.data_utils import set_loader_epoch, set_train_img_size, DevicePrefetcher, IMAGENET_MEAN, IMAGENET_STD
+from utils.eval_cache import normalize_batch
+
+
+class EpochDataset(IterableDataset):
+    """Yields the epoch it was told about, as seen from inside the worker."""
+    def __init__(self):
+        self.epoch = 0
+
+    def set_epoch(self, epoch, start_index=0):
+        self.epoch = epoch
+
+    def __iter__(self):
+        for _ in range(4):
+            yield torch.tensor(self.epoch)
+
+
+class TransformSizeDataset(Dataset):
+    """Returns the crop size of its current train transform, as seen from inside the worker."""
+    def __init__(self):
+        self.transform = None
+
+    def __len__(self):
+        return 4
+
+    def __getitem__(self, index):
+        return torch.tensor(self.transform.transforms[0].size[0])
+
+
+def test_set_loader_epoch_reaches_persistent_workers():
+    loader = DataLoader(EpochDataset(), batch_size=2, num_workers=1, persistent_workers=True)
+    for epoch in range(3):
+        set_loader_epoch(loader, epoch)
+        assert all((batch == epoch).all() for batch in loader)
+
+
+def test_set_train_img_size_reaches_persistent_workers():
+    loader = DataLoader(TransformSizeDataset(), batch_size=2, num_workers=1, persistent_workers=True)
+    for img_size in (128, 160, 224):
+        set_train_img_size(loader, img_size)
+        assert all((batch == img_size).all() for batch in loader)
+
+
+def test_normalize_batch_matches_to_tensor_and_normalize():
+    pixels = np.random.RandomState(0).randint(0, 256, (2, 8, 8, 3), dtype=np.uint8)
+    reference = transforms.Compose([transforms.ToTensor(), transforms.Normalize(IMAGENET_MEAN, IMAGENET_STD)])
+    expected = torch.stack([reference(Image.fromarray(image)) for image in pixels])
+    batch = torch.from_numpy(pixels).permute(0, 3, 1, 2)
+    assert torch.allclose(normalize_batch(batch, IMAGENET_MEAN, IMAGENET_STD), expected, atol=1e-5)
+
+
+def test_device_prefetcher_yields_every_batch_in_order_on_cpu():
+    images = torch.arange(10, dtype=torch.uint8).view(10, 1, 1, 1).expand(10, 3, 2, 2).contiguous()
+    loader = DataLoader(TensorDataset(images, torch.arange(10)), batch_size=3)
+    prefetcher = DevicePrefetcher(loader, "cpu", mean=(0.0, 0.0, 0.0), std=(1.0, 1.0, 1.0))
+    for _ in range(2):
+        batches = list(prefetcher)
+        assert len(batches) == len(loader)
+        assert torch.equal(torch.cat([y for _, y in batches]), torch.arange(10))
+        for x, y in batches:
+            assert x.dtype == torch.float32
+            assert torch.allclose(x[:, 0, 0, 0], y.float() / 255)
@@ -0,0 +1,64 @@
+import json
+import os
+import sys
+
+from collections import Counter
+
+import pytest
+
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from utils import shard_dataset
+from utils.shard_dataset import ShardedImageDataset, SHARD_INDEX, write_shard
+
+
+class WorkerInfo(object):
+    def __init__(self, id, num_workers):
+        self.id = id
+        self.num_workers = num_workers
+
+
+def make_shard_dir(root, shard_sizes):
+    """Shards of 1x1 PNGs whose red value is the sample index."""
+    names, offset = [], 0
+    for shard_idx, size in enumerate(shard_sizes):
+        paths = []
+        for idx in range(offset, offset + size):
+            path = os.path.join(root, "%03d.png" % idx)
+            Image.new("RGB", (1, 1), (idx, 0, 0)).save(path)
+            paths.append((path, 0))
+        names.append("shard_%d.tar" % shard_idx)
+        write_shard(os.path.join(root, names[-1]), paths, offset)
+        offset += size
+    with open(os.path.join(root, SHARD_INDEX), "w") as f:
+        json.dump({"shards": names, "sizes": list(shard_sizes), "classes": ["a"]}, f)
+    return root
+
+
+def read_epoch(monkeypatch, shard_dir, world_size, num_workers, epoch=0):
+    seen = Counter()
+    for rank in range(world_size):
+        monkeypatch.setattr(shard_dataset, "get_rank", lambda: rank)
+        monkeypatch.setattr(shard_dataset, "get_world_size", lambda: world_size)
+        dataset = ShardedImageDataset(shard_dir, transform=lambda img: img.getpixel((0, 0))[0], shuffle_buffer=3)
+        dataset.set_epoch(epoch)
+        for worker_id in range(num_workers):
+            monkeypatch.setattr(shard_dataset, "get_worker_info", lambda: WorkerInfo(worker_id, num_workers))
+            samples = [idx for idx, _ in dataset]
+            seen.update(samples)
+        assert sum(seen.values()) == (rank + 1) * len(dataset)
+    return seen
+
+
+@pytest.mark.parametrize("world_size,num_workers", [(1, 1), (1, 2), (1, 8), (2, 3), (3, 4)])
+def test_every_sample_once_per_epoch(tmp_path, monkeypatch, world_size, num_workers):
+    shard_sizes = [5, 4, 5, 3, 7]
+    shard_dir = make_shard_dir(str(tmp_path), shard_sizes)
+    total = sum(shard_sizes)
+    for epoch in range(2):
+        seen = read_epoch(monkeypatch, shard_dir, world_size, num_workers, epoch)
+        assert max(seen.values()) == 1
+        assert len(seen) == total // world_size * world_size
+        if world_size == 1:
+            assert set(seen) == set(range(total))
@@ -4,6 +4,7 @@ import logging
 import argparse
 import os
 import random
+import time
 import numpy as np
 
 from datetime import timedelta
@@ -15,10 +16,15 @@ from tqdm import tqdm
 from torch.utils.tensorboard import SummaryWriter
 from torch.nn.parallel import DistributedDataParallel as DDP
 
-from model_vit import VisionTransformer, CONFIGS
+from vit_models import VisionTransformer, CONFIGS, build_pretrained
 from utils.scheduler import WarmupLinearSchedule, WarmupCosineSchedule
-from utils.data_utils import get_loader
-from utils.dist_util import get_world_size
+from utils.data_utils import get_loader, set_loader_epoch, set_train_img_size, TimedLoader, DevicePrefetcher, \
+    NORM_MEAN, NORM_STD
+from utils.eval_cache import normalize_batch
+from utils.profiling import StepProfiler
+from utils.memory_planner import plan_batch
+from utils.checkpoint import CheckpointManager, get_rng_state, set_rng_state, load_checkpoint
+from utils.dist_util import get_rank, get_world_size
 
 logger = logging.getLogger(__name__)
 
@@ -39,9 +45,6 @@ class AverageMeter(object):
         self.count += n
         self.avg = self.sum / self.count
 
-def simple_accuracy(preds, labels):
-    return (preds == labels).mean()
-
 def save_model(args, model):
     model_to_save = model.module if hasattr(model, 'module') else model
     model_checkpoint = os.path.join(args.output_dir, "%s_checkpoint.bin" % args.name)
@@ -54,9 +57,19 @@ def setup(args):
     
     num_classes = 1000 # ImageNet-1K
     
-    model = VisionTransformer(config, args.img_size, zero_head=True, num_classes=num_classes)
-    # We are not loading in any pretrained model, rather we are training from scratch instead (testing out performance with ImageNet-1K
-    # model.load_from(np.load(args.pretrained_dir))
+    if args.pretrained_dir is None:
+        # Training from scratch (testing out performance with ImageNet-1K)
+        model = VisionTransformer(config, args.img_size, zero_head=True, num_classes=num_classes,
+                                  token_keep_ratio=args.token_keep_ratio)
+    elif args.pretrained_dir.endswith(".npz"):
+        model = VisionTransformer(config, args.img_size, zero_head=True, num_classes=num_classes,
+                                  token_keep_ratio=args.token_keep_ratio)
+        model.load_from(np.load(args.pretrained_dir))
+    else:
+        # Checkpoint converted with convert_checkpoint.py, memory-mapped straight into the parameters
+        model = build_pretrained(config, args.pretrained_dir, args.img_size, zero_head=True, num_classes=num_classes,
+                                 token_keep_ratio=args.token_keep_ratio)
+    model.transformer.encoder.gradient_checkpointing = args.gradient_checkpointing
     model.to(args.device)
     num_params = count_parameters(model)
     
@@ -86,51 +99,80 @@ def valid(args, model, writer, test_loader, global_step):
     logger.info("   Batch size = %d", args.eval_batch_size)
     
     model.eval()
-    all_preds, all_label = [], []
+    # Each rank evaluates its own shard of the validation set. Predictions and
+    # per-sample losses are written into buffers preallocated on the device and
+    # reduced across ranks once at the end.
+    num_samples = len(test_loader.sampler)
+    all_preds = torch.empty(num_samples, dtype=torch.long, device=args.device)
+    all_label = torch.empty(num_samples, dtype=torch.long, device=args.device)
+    all_losses = torch.empty(num_samples, dtype=torch.float, device=args.device)
     epoch_iterator = tqdm(test_loader,
                           desc="Validating... (loss=X.X)",
                           bar_format="{l_bar}{r_bar}",
                           dynamic_ncols=True,
                           disable=args.local_rank not in [-1, 0])
-    loss_fct = torch.nn.CrossEntropyLoss()
+    loss_fct = torch.nn.CrossEntropyLoss(reduction="none")
+    offset = 0
     for step, batch in enumerate(epoch_iterator):
-        batch = tuple(t.to(args.device) for t in batch)
+        batch = tuple(t.to(args.device, non_blocking=True) for t in batch)
         x, y = batch
+        if x.dtype == torch.uint8:
+            x = normalize_batch(x, args.norm_mean, args.norm_std)
         with torch.no_grad():
             # Indicating the CLS token
             logits = model(x)[0]
             
             eval_loss = loss_fct(logits, y)
-            eval_losses.update(eval_loss.item())
-            
             preds = torch.argmax(logits, dim=-1)
         
-        if len(all_preds) == 0:
-            all_preds.append(preds.detach().cpu().numpy())
-            all_label.append(y.detach().cpu().numpy())
-        else:
-            all_preds[0] = np.append(
-                all_preds[0], preds.detach().cpu().numpy(), axis=0
-            )
-            all_label[0] = np.append(
-                all_label[0], y.detach().cpu().numpy(), axis=0
-            )
-        epoch_iterator.set_description("Validating... (loss=%2.5f)" % eval_losses.val)
+        batch_size = y.size(0)
+        all_preds[offset:offset + batch_size] = preds
+        all_label[offset:offset + batch_size] = y
+        all_losses[offset:offset + batch_size] = eval_loss
+        offset += batch_size
+        if args.local_rank in [-1, 0]:
+            eval_losses.update(eval_loss.mean().item())
+            epoch_iterator.set_description("Validating... (loss=%2.5f)" % eval_losses.val)
+    
+    # DistributedSampler pads the dataset so that every rank gets the same number
+    # of samples; rank r holds global positions r, r + world_size, ... and the
+    # positions past the end of the dataset are duplicates that must not count.
+    world_size = get_world_size()
+    rank = get_rank()
+    positions = torch.arange(offset, device=args.device) * world_size + rank
+    valid_mask = (positions < len(test_loader.dataset)).float()
     
-    all_preds, all_label = all_preds[0], all_label[0]
-    accuracy = simple_accuracy(all_preds, all_label)
+    totals = torch.stack([
+        ((all_preds[:offset] == all_label[:offset]).float() * valid_mask).sum(),
+        (all_losses[:offset] * valid_mask).sum(),
+        valid_mask.sum(),
+    ])
+    if world_size > 1:
+        dist.all_reduce(totals, op=dist.ReduceOp.SUM)
+    num_correct, loss_sum, num_seen = totals.tolist()
+    accuracy = num_correct / max(num_seen, 1)
+    eval_loss = loss_sum / max(num_seen, 1)
     
     logger.info("\n")
     logger.info("Validation Results")
     logger.info("Global Steps: %d" % global_step)
-    logger.info("Valid Loss: %2.5f" % eval_losses.avg)
+    logger.info("Valid Loss: %2.5f" % eval_loss)
     logger.info("Valid Accuracy: %2.5f" % accuracy)
     
-    writer.add_scalar("test/accuracy", scalar_value=accuracy, global_step=global_step)
+    if writer is not None:
+        writer.add_scalar("test/accuracy", scalar_value=accuracy, global_step=global_step)
     return accuracy
 
+def get_train_img_size(args, epoch):
+    """Training resolution for `epoch` under the progressive resizing schedule."""
+    if not args.progressive_sizes:
+        return args.img_size
+    stage = sum(epoch >= start for start in args.progressive_epochs)
+    return args.progressive_sizes[min(stage, len(args.progressive_sizes) - 1)]
+
 def train(args, model):
     """ Train the Model """
+    writer = None
     if args.local_rank in [-1, 0]:
         os.makedirs(args.output_dir, exist_ok=True)
         writer = SummaryWriter(log_dir=os.path.join("logs", args.name))
@@ -153,6 +195,24 @@ def train(args, model):
     else:
         scheduler = WarmupLinearSchedule(optimizer, warmup_steps=warmup_steps, t_total=t_total)
     
+    checkpointer = CheckpointManager(args.output_dir, args.name, keep_last=args.keep_checkpoints)
+    global_step, best_acc, epoch, epoch_step = 0, 0, 0, 0
+    elapsed, target_reached = 0.0, False
+    resume_state = None
+    if args.resume is not None:
+        resume_path = checkpointer.latest() if args.resume == "latest" else args.resume
+        if resume_path is None:
+            logger.warning("No checkpoint found in %s, training from scratch", args.output_dir)
+        else:
+            resume_state = load_checkpoint(resume_path)
+            model.load_state_dict(resume_state["model"])
+            optimizer.load_state_dict(resume_state["optimizer"])
+            scheduler.load_state_dict(resume_state["scheduler"])
+            global_step, best_acc = resume_state["global_step"], resume_state["best_acc"]
+            epoch, epoch_step = resume_state["epoch"], resume_state["epoch_step"]
+            elapsed = resume_state.get("elapsed", 0.0)
+            logger.info("Resumed from %s at step %d (epoch %d, batch %d)", resume_path, global_step, epoch, epoch_step)
+    
     # Distributed training
     if args.local_rank != -1:
         model = DDP(model, message_size=250000000, gradient_predivide_factor=get_world_size())
@@ -168,32 +228,62 @@ def train(args, model):
     
     model.zero_grad()
     set_seed(args) # Added here for reproducibility (even between python 2 and 3)
+    if resume_state is not None:
+        set_rng_state(resume_state["rng"])
+        resume_state = None
     losses = AverageMeter()
-    global_step, best_acc = 0, 0
+    step_times = AverageMeter()
+    wait_time = 0.0
+    profiler = StepProfiler(model, writer, every=args.profile_every,
+                            trace_dir=os.path.join("logs", args.name), trace_steps=args.profile_trace_steps)
+    train_img_size = args.img_size
+    start_time = time.time() - elapsed
     while True:
         model.train()
-        epoch_iterator = tqdm(train_loader,
+        if get_train_img_size(args, epoch) != train_img_size:
+            train_img_size = get_train_img_size(args, epoch)
+            set_train_img_size(train_loader, train_img_size, mean=args.norm_mean, std=args.norm_std,
+                               uint8=args.device_normalize, draft=args.draft_decode)
+            logger.info("Epoch %d: training at resolution %d", epoch, train_img_size)
+        # Skip the part of the epoch that was already trained on before the resume
+        set_loader_epoch(train_loader, epoch, epoch_step * args.train_batch_size)
+        if args.device_normalize:
+            timed_loader = TimedLoader(DevicePrefetcher(train_loader, args.device, args.norm_mean, args.norm_std,
+                                                        flip=args.device_flip))
+        else:
+            timed_loader = TimedLoader(train_loader)
+        epoch_iterator = tqdm(timed_loader,
                               desc="Training (X / X Steps) (loss=X.X)",
                               bar_format="{l_bar}{r_bar}",
                               dynamic_ncols=True,
                               disable=args.local_rank not in [-1, 0])
         
-        for step, batch in enumerate(epoch_iterator):
+        step_start = time.time()
+        for step, batch in enumerate(epoch_iterator, start=epoch_step):
+            profiler.start_step(global_step + 1)
+            profiler.add("data", timed_loader.last_wait)
+            wait_time += timed_loader.last_wait
             batch = tuple(t.to(args.device) for t in batch)
             x, y = batch
-            loss = model(x, y)
+            with profiler.phase("forward"):
+                loss = model(x, y)
             
             if args.gradient_accumulation_steps > 1:
                 loss = loss / args.gradient_accumulation_steps
+            with profiler.phase("backward"):
                 loss.backward()
             
             if (step + 1) % args.gradient_accumulation_steps == 0:
                 losses.update(loss.item()*args.gradient_accumulation_steps)
-                torch.nn.utils.clip_grad_norm(model.parameters(), args.max_grad_norm)
-                scheduler.step()
-                optimizer.step()
-                optimizer.zero_grad()
+                with profiler.phase("clip_grad_norm"):
+                    torch.nn.utils.clip_grad_norm(model.parameters(), args.max_grad_norm)
+                with profiler.phase("optimizer"):
+                    scheduler.step()
+                    optimizer.step()
+                    optimizer.zero_grad()
                 global_step += 1
+                step_times.update(time.time() - step_start)
+                profiler.end_step()
                 
                 epoch_iterator.set_description(
                     "Training (%d / %d Steps) (loss=%2.5f)" % (global_step, t_total, losses.val)
@@ -201,21 +291,63 @@ def train(args, model):
                 if args.local_rank in [-1, 0]:
                     writer.add_scalar("train/loss", scalar_value=losses.val, global_step=global_step)
                     writer.add_scalar("train/lr", scalar_value=scheduler.get_lr()[0], global_step=global_step)
-                if global_step % args.eval_every == 0 and args.local_rank in [-1, 0]:
+                    writer.add_scalar("train/step_time", scalar_value=step_times.val, global_step=global_step)
+                    # Time blocked on the loader vs. compute; a high ratio means the workers cannot keep up
+                    writer.add_scalar("loader/wait_ratio", scalar_value=wait_time / step_times.val, global_step=global_step)
+                    writer.add_scalar("loader/images_per_sec",
+                                      scalar_value=args.train_batch_size * args.gradient_accumulation_steps / step_times.val,
+                                      global_step=global_step)
+                    queue_depth = timed_loader.queue_depth()
+                    if queue_depth is not None:
+                        writer.add_scalar("loader/queue_depth", scalar_value=queue_depth, global_step=global_step)
+                wait_time = 0.0
+                if global_step % args.eval_every == 0:
+                    # Every rank validates its shard; only the main process saves.
                     accuracy = valid(args, model, writer, test_loader, global_step)
+                    elapsed = time.time() - start_time
+                    logger.info("Wall-clock time: %.1fs", elapsed)
+                    if args.target_accuracy is not None and accuracy >= args.target_accuracy and not target_reached:
+                        # Compare runs (e.g. progressive vs. fixed resolution) by time to target
+                        target_reached = True
+                        logger.info("Reached target accuracy %2.5f after %.1fs", args.target_accuracy, elapsed)
+                        if writer is not None:
+                            writer.add_scalar("test/time_to_target", scalar_value=elapsed, global_step=global_step)
                     if best_acc < accuracy:
-                        save_model(args, model)
+                        if args.local_rank in [-1, 0]:
+                            save_model(args, model)
                         best_acc = accuracy
                     model.train()
                 
+                if global_step % args.save_every == 0 or global_step % t_total == 0:
+                    if args.local_rank in [-1, 0]:
+                        model_to_save = model.module if hasattr(model, 'module') else model
+                        checkpointer.save({
+                            "model": model_to_save.state_dict(),
+                            "optimizer": optimizer.state_dict(),
+                            "scheduler": scheduler.state_dict(),
+                            "global_step": global_step,
+                            "best_acc": best_acc,
+                            "epoch": epoch,
+                            "epoch_step": step + 1,
+                            "rng": get_rng_state(),
+                            "elapsed": time.time() - start_time,
+                        }, global_step)
+                
                 if global_step % t_total == 0:
                     break
+                step_start = time.time()
         losses.reset()
         if global_step % t_total == 0:
             break
+        epoch += 1
+        epoch_step = 0
     
+    checkpointer.wait()
+    profiler.close()
     if args.local_rank in [-1, 0]:
         writer.close()
+    # Compare against a run with --token_keep_ratio 1.0 to measure the gain from token dropout
+    logger.info("Average step time: \t%.4fs (token keep ratio %.2f)" % (step_times.avg, args.token_keep_ratio))
     logger.info("Best Accuracy: \t%f" % best_acc)
     logger.info("End Training!")
 
@@ -228,13 +360,64 @@ def main():
     parser.add_argument("--model_type", choices=["ViT-L_16", "ViT-H_14"],
                         default="ViT-L_16",
                         help="Which variant to use.")
+    parser.add_argument("--pretrained_dir", default=None, type=str,
+                        help="Optional pretrained ViT weights: a JAX .npz file or a checkpoint converted "
+                        "with convert_checkpoint.py. Train from scratch if not given.")
     parser.add_argument("--output_dir", default="output", type=str,
                         help="The output directory where checkpoints will be written.")
     
     parser.add_argument("--img_size", default=224, type=int,
                         help="Resolution size")
+    parser.add_argument("--progressive_sizes", nargs="+", type=int, default=None,
+                        help="Progressive resizing: training resolutions used in turn, e.g. 128 160 224. "
+                        "Validation always runs at --img_size.")
+    parser.add_argument("--progressive_epochs", nargs="+", type=int, default=[],
+                        help="Epochs at which training switches to the next of --progressive_sizes.")
+    parser.add_argument("--target_accuracy", default=None, type=float,
+                        help="Log the wall-clock time at which validation accuracy first reaches this value.")
+    parser.add_argument("--token_keep_ratio", default=1.0, type=float,
+                        help="Token dropout: fraction of patch tokens kept per training sample "
+                        "(the CLS token is always kept). 1.0 disables it; eval always uses every token.")
     parser.add_argument("--train_batch_size", default=42, type=int,
                         help="Total batch size of training.")
+    parser.add_argument("--data_root", default="imagenet", type=str,
+                        help="Directory holding the train and val folders. Their file index is cached in "
+                        "train.manifest.npz and val.manifest.npz next to them.")
+    parser.add_argument("--data_backend", choices=["folder", "tar", "shards"], default="folder",
+                        help="Read the train set from the extracted imagenet/train folders, directly from "
+                        "--train_tar, or from the shards in --train_shards.")
+    parser.add_argument("--train_tar", default="ILSVRC2012_img_train.tar", type=str,
+                        help="Train tar for --data_backend tar; indexed into <tar>.index.npz on first use.")
+    parser.add_argument("--train_shards", default="imagenet/train_shards", type=str,
+                        help="Shard directory written by make_shards.py for --data_backend shards.")
+    parser.add_argument("--shuffle_buffer", default=1000, type=int,
+                        help="Encoded samples held in memory per loader worker to shuffle within shards "
+                        "(ImageNet JPEGs average ~110 KB, so ~110 MB per worker at 1000).")
+    parser.add_argument("--norm_mean", nargs=3, type=float, default=list(NORM_MEAN),
+                        help="Per-channel mean used to normalize images (ImageNet statistics: 0.485 0.456 0.406).")
+    parser.add_argument("--norm_std", nargs=3, type=float, default=list(NORM_STD),
+                        help="Per-channel std used to normalize images (ImageNet statistics: 0.229 0.224 0.225).")
+    parser.add_argument("--device_normalize", action="store_true",
+                        help="Loader workers return uint8 images; the dtype conversion and normalization run "
+                        "batched on the device, overlapped with the previous step.")
+    parser.add_argument("--device_flip", action="store_true",
+                        help="With --device_normalize, also flip training images horizontally at random on the device.")
+    parser.add_argument("--draft_decode", action="store_true",
+                        help="Pick the RandomResizedCrop box before decoding and decode JPEGs at the smallest "
+                        "DCT scale that still covers it (ImageFolder backend).")
+    parser.add_argument("--eval_cache", default=None, type=str,
+                        help="Directory for a pre-decoded uint8 copy of imagenet/val (built on first use) "
+                        "to validate from instead of decoding the JPEGs every evaluation.")
+    parser.add_argument("--num_workers", default=4, type=int,
+                        help="DataLoader worker processes.")
+    parser.add_argument("--prefetch_factor", default=2, type=int,
+                        help="Batches prefetched by each DataLoader worker.")
+    parser.add_argument("--persistent_workers", action="store_true",
+                        help="Keep DataLoader workers alive between epochs instead of restarting them.")
+    parser.add_argument("--no_pin_memory", dest="pin_memory", action="store_false",
+                        help="Do not copy batches into pinned host memory.")
+    parser.add_argument("--autotune_loader", action="store_true",
+                        help="Try several --num_workers/--prefetch_factor settings at startup and use the fastest.")
     parser.add_argument("--eval_batch_size", default=32, type=int,
                         help="Total batch size for eval.")
     parser.add_argument("--eval_every", default=5000, type=int,
@@ -252,6 +435,18 @@ def main():
                         help="Step of training to perform learning rate warmup for.")
     parser.add_argument("--max_grad_norm", default=1.0, type=float,
                         help="Max gradient norm.")
+    parser.add_argument("--profile_every", default=0, type=int,
+                        help="Time the training phases and every Block on one step out of this many and "
+                        "write them to TensorBoard under profile/. 0 disables profiling.")
+    parser.add_argument("--profile_trace_steps", nargs=2, type=int, default=None,
+                        help="First and last step to record as a Chrome trace in logs/<name>.")
+    parser.add_argument("--save_every", default=1000, type=int,
+                        help="Write a full training-state checkpoint every so many steps.")
+    parser.add_argument("--keep_checkpoints", default=3, type=int,
+                        help="Number of most recent training-state checkpoints to keep.")
+    parser.add_argument("--resume", nargs="?", const="latest", default=None, type=str,
+                        help="Resume training from a training-state checkpoint. "
+                        "Without a path, the latest checkpoint in --output_dir is used.")
     
     parser.add_argument("--local_rank", type=int, default=-1,
                         help="local_rank for distributed training on gpus")
@@ -259,6 +454,13 @@ def main():
                         help="random seed for initialization")
     parser.add_argument("--gradient_accumulation_steps", type=int, default=1,
                         help="Number of updates steps to accumulate before performing a backward/update pass.")
+    parser.add_argument("--gradient_checkpointing", action="store_true",
+                        help="Recompute Block activations during backward instead of storing them.")
+    parser.add_argument("--auto_batch", action="store_true",
+                        help="Pick the micro-batch and --gradient_accumulation_steps from a memory estimate "
+                        "(checked by a probe run on GPU) so that --train_batch_size fits in memory.")
+    parser.add_argument("--memory_budget_gb", type=float, default=None,
+                        help="Memory budget for --auto_batch. Defaults to 90%% of the GPU memory.")
     parser.add_argument("--fp16", action="store_true",
                         help="Whether to use 16-bit float precision instead of 32-bit")
     parser.add_argument("--loss_scale", type=float, default=0,
@@ -266,6 +468,12 @@ def main():
                         "0 (default value): dynamic loss scaling.\n"
                         "Positive power of 2: static loss scaling value.\n")
     args = parser.parse_args()
+    if args.progressive_sizes and len(args.progressive_epochs) != len(args.progressive_sizes) - 1:
+        parser.error("--progressive_epochs needs one epoch per switch between --progressive_sizes")
+    if args.auto_batch and args.memory_budget_gb is None and not torch.cuda.is_available():
+        parser.error("--auto_batch needs --memory_budget_gb when no GPU is available")
+    if args.keep_checkpoints < 1:
+        parser.error("--keep_checkpoints must be at least 1")
     
     # Setup CUDA, GPU & distributed training
     if args.local_rank == -1:
@@ -293,6 +501,21 @@ def main():
     # Model & Tokenizer Setup
     args, model = setup(args)
     
+    if args.auto_batch:
+        # Largest micro-batch that fits, accumulated up to --train_batch_size
+        if args.memory_budget_gb is not None:
+            memory_budget = args.memory_budget_gb * 1024 ** 3
+        else:
+            memory_budget = 0.9 * torch.cuda.get_device_properties(args.device).total_memory
+        micro_batch, accumulation_steps, _ = plan_batch(CONFIGS[args.model_type], args.img_size,
+                                                        args.train_batch_size, memory_budget,
+                                                        # Training runs without autocast, so activations are fp32
+                                                        precision="fp32",
+                                                        checkpointing=args.gradient_checkpointing,
+                                                        model=model, device=args.device)
+        args.gradient_accumulation_steps = accumulation_steps
+        args.train_batch_size = micro_batch * accumulation_steps
+    
     # Training
     train(args, model)
 
@@ -0,0 +1,111 @@
+import glob
+import logging
+import os
+import random
+import re
+import threading
+
+import numpy as np
+import torch
+
+logger = logging.getLogger(__name__)
+
+
+def to_cpu(obj):
+    """Recursively copies every tensor in a (nested) state dict to the CPU."""
+    if torch.is_tensor(obj):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        return {k: to_cpu(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(to_cpu(v) for v in obj)
+    return obj
+
+
+def get_rng_state():
+    state = {
+        "python": random.getstate(),
+        "numpy": np.random.get_state(),
+        "torch": torch.get_rng_state(),
+    }
+    if torch.cuda.is_available():
+        state["cuda"] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state["python"])
+    np.random.set_state(state["numpy"])
+    torch.set_rng_state(state["torch"])
+    if "cuda" in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state["cuda"])
+
+
+class CheckpointManager(object):
+    """
+    Writes full training-state checkpoints from a background thread.
+    The state is snapshotted to the CPU on the calling thread, so training can continue
+    while the snapshot is serialized. Files are written to a temporary name and renamed
+    into place, and only the last `keep_last` checkpoints are kept.
+    """
+    def __init__(self, output_dir, name, keep_last=3):
+        if keep_last < 1:
+            # The newest checkpoint is what a resume starts from
+            raise ValueError("keep_last must be at least 1, got %d" % keep_last)
+        self.output_dir = output_dir
+        self.name = name
+        self.keep_last = keep_last
+        self._thread = None
+        self._error = None
+        os.makedirs(output_dir, exist_ok=True)
+
+    def path_for(self, step):
+        return os.path.join(self.output_dir, "%s_step%d.ckpt" % (self.name, step))
+
+    def checkpoints(self):
+        """Returns the existing checkpoints of this run, oldest first."""
+        pattern = re.compile(r"%s_step(\d+)\.ckpt$" % re.escape(self.name))
+        found = []
+        for path in glob.glob(os.path.join(self.output_dir, "%s_step*.ckpt" % self.name)):
+            match = pattern.search(os.path.basename(path))
+            if match:
+                found.append((int(match.group(1)), path))
+        return [path for _, path in sorted(found)]
+
+    def latest(self):
+        checkpoints = self.checkpoints()
+        return checkpoints[-1] if checkpoints else None
+
+    def save(self, state, step):
+        # Only one write in flight: this bounds host memory to a single snapshot.
+        self.wait()
+        snapshot = to_cpu(state)
+        self._thread = threading.Thread(target=self._write, args=(snapshot, step), daemon=True)
+        self._thread.start()
+
+    def _write(self, snapshot, step):
+        path = self.path_for(step)
+        tmp_path = path + ".tmp"
+        try:
+            torch.save(snapshot, tmp_path)
+            os.replace(tmp_path, path)
+            logger.info("Saved training checkpoint to [FILE: %s]", path)
+            for old_path in self.checkpoints()[:-self.keep_last]:
+                os.remove(old_path)
+        except Exception as e:
+            self._error = e
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def wait(self):
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise RuntimeError("Writing training checkpoint failed") from error
+
+
+def load_checkpoint(path):
+    # The state holds Python/NumPy RNG states, so it cannot be loaded weights-only.
+    return torch.load(path, map_location="cpu", weights_only=False)
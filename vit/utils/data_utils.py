@@ -1,47 +1,304 @@
+import itertools
 import logging
+import os
+import time
+
+from contextlib import nullcontext
 
 import torch
+import torch.distributed as dist
 
 from torchvision import transforms, datasets
-from torch.utils.data import DataLoader, RandomSampler, DistributedSampler, SequentialSampler
+from torch.utils.data import DataLoader, RandomSampler, DistributedSampler, SequentialSampler, Sampler
+
+from utils.tar_dataset import TarImageDataset
+from utils.shard_dataset import ShardedImageDataset
+from utils.eval_cache import EvalCacheDataset, build_eval_cache, normalize_batch, collate_eval_cache
+from utils.jpeg_draft import DraftRandomResizedCrop, lazy_pil_loader
+from utils.manifest_dataset import ManifestImageFolder
+from utils.dist_util import get_rank, get_world_size
 
 logger = logging.getLogger(__name__)
 
+NORM_MEAN = (0.5, 0.5, 0.5)
+NORM_STD = (0.5, 0.5, 0.5)
+# torchvision's pretrained models (cka/model_compare.py, quantize.py, ...) expect the ImageNet statistics
+IMAGENET_MEAN = (0.485, 0.456, 0.406)
+IMAGENET_STD = (0.229, 0.224, 0.225)
+
+class ResumableSampler(Sampler):
+    """
+    Wraps a training sampler so that the order of every epoch is seeded by the epoch
+    number and iteration can start part way through an epoch after a resume.
+    """
+    def __init__(self, sampler, seed=0):
+        self.sampler = sampler
+        self.seed = seed
+        self.epoch = 0
+        self.start_index = 0
+    
+    def set_epoch(self, epoch, start_index=0):
+        self.epoch = epoch
+        self.start_index = start_index
+        if hasattr(self.sampler, "set_epoch"):
+            self.sampler.set_epoch(epoch)
+        elif getattr(self.sampler, "generator", None) is not None:
+            self.sampler.generator.manual_seed(self.seed + epoch)
+    
+    def __iter__(self):
+        return itertools.islice(iter(self.sampler), self.start_index, None)
+    
+    def __len__(self):
+        return max(len(self.sampler) - self.start_index, 0)
+
+def restart_workers(loader):
+    """
+    Persistent workers keep the copy of the dataset they were started with, so changes to
+    `loader.dataset` never reach them. Shuts them down so that the next epoch starts fresh
+    workers from the current dataset.
+    """
+    iterator = getattr(loader, "_iterator", None)
+    if iterator is not None:
+        iterator._shutdown_workers()
+        loader._iterator = None
+
+def set_loader_epoch(loader, epoch, start_index=0):
+    """Starts `epoch` of the training loader, skipping the first `start_index` samples."""
+    if hasattr(loader.sampler, "set_epoch"):
+        loader.sampler.set_epoch(epoch, start_index)
+    elif hasattr(loader.dataset, "set_epoch"):
+        # Iterable datasets shuffle and shard themselves, inside the workers
+        loader.dataset.set_epoch(epoch, start_index)
+        restart_workers(loader)
+
+class TimedLoader(object):
+    """
+    Iterates a DataLoader and records how long each `next()` blocked waiting for the batch.
+    """
+    def __init__(self, loader):
+        self.loader = loader
+        self.iterator = None
+        self.last_wait = 0.0
+    
+    def __iter__(self):
+        self.iterator = iter(self.loader)
+        return self
+    
+    def __next__(self):
+        start = time.perf_counter()
+        batch = next(self.iterator)
+        self.last_wait = time.perf_counter() - start
+        return batch
+    
+    def __len__(self):
+        return len(self.loader)
+    
+    def queue_depth(self):
+        """
+        Batches already prefetched by the workers and ready to be consumed. Reads private
+        fields of the DataLoader iterator; None without workers or if this torch version
+        does not have them.
+        """
+        # Look through a DevicePrefetcher to the DataLoader iterator
+        iterator = getattr(self.iterator, "loader_iterator", self.iterator)
+        data_queue = getattr(iterator, "_data_queue", None)
+        task_info = getattr(iterator, "_task_info", None)
+        if data_queue is None or not isinstance(task_info, dict):
+            return None
+        try:
+            ready = data_queue.qsize()
+        except NotImplementedError:
+            ready = 0
+        # Batches that arrived out of order are buffered until their turn
+        ready += sum(1 for info in task_info.values() if len(info) == 2)
+        return ready
+
+class DevicePrefetcher(object):
+    """
+    Wraps a DataLoader whose workers return uint8 CHW images. One batch ahead, the batch is
+    copied to `device`, converted to float and normalized there (and optionally flipped
+    horizontally per sample), so workers never build float tensors and the pinned host
+    batches stay at a quarter of the size. On CUDA this runs on a side stream to overlap
+    with the current step; on the CPU it runs inline.
+    """
+    def __init__(self, loader, device, mean=NORM_MEAN, std=NORM_STD, flip=False):
+        self.loader = loader
+        self.device = torch.device(device)
+        self.mean = mean
+        self.std = std
+        self.flip = flip
+        self.stream = torch.cuda.Stream(self.device) if self.device.type == "cuda" else None
+        self.loader_iterator = None
+        self.next_batch = None
+    
+    def __len__(self):
+        return len(self.loader)
+    
+    def _preload(self):
+        try:
+            x, y = next(self.loader_iterator)
+        except StopIteration:
+            return None
+        with torch.cuda.stream(self.stream) if self.stream is not None else nullcontext():
+            x = x.to(self.device, non_blocking=True)
+            y = y.to(self.device, non_blocking=True)
+            x = normalize_batch(x, self.mean, self.std)
+            if self.flip:
+                flip = torch.rand(x.size(0), device=self.device) < 0.5
+                x = torch.where(flip.view(-1, 1, 1, 1), x.flip(3), x)
+        return x, y
+    
+    def __iter__(self):
+        self.loader_iterator = iter(self.loader)
+        self.next_batch = self._preload()
+        return self
+    
+    def __next__(self):
+        batch = self.next_batch
+        if batch is None:
+            raise StopIteration
+        if self.stream is not None:
+            current_stream = torch.cuda.current_stream(self.device)
+            current_stream.wait_stream(self.stream)
+            for t in batch:
+                t.record_stream(current_stream)
+        self.next_batch = self._preload()
+        return batch
+
+def benchmark_loader(loader, num_batches=50, num_warmup=5):
+    """Images/sec of `loader` over `num_batches` batches, after `num_warmup` batches."""
+    iterator = iter(loader)
+    for _ in range(num_warmup):
+        next(iterator)
+    start = time.perf_counter()
+    num_images = 0
+    for _ in range(num_batches):
+        try:
+            x = next(iterator)[0]
+        except StopIteration:
+            break
+        num_images += x.size(0)
+    return num_images / (time.perf_counter() - start)
+
+def autotune_loader(dataset, sampler, args, num_batches=30):
+    """Tries several num_workers/prefetch_factor settings and returns the fastest pair."""
+    max_workers = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count()
+    candidates = [(w, p) for w in (2, 4, 8, 16, 32) if w <= max_workers for p in (2, 4)]
+    best, best_throughput = (args.num_workers, args.prefetch_factor), 0.0
+    for num_workers, prefetch_factor in candidates:
+        loader = DataLoader(dataset,
+                            sampler=sampler,
+                            batch_size=args.train_batch_size,
+                            num_workers=num_workers,
+                            prefetch_factor=prefetch_factor,
+                            pin_memory=args.pin_memory)
+        throughput = benchmark_loader(loader, num_batches=num_batches, num_warmup=num_workers)
+        logger.info("Loader autotune: num_workers=%d prefetch_factor=%d: %.1f images/sec",
+                    num_workers, prefetch_factor, throughput)
+        if throughput > best_throughput:
+            best, best_throughput = (num_workers, prefetch_factor), throughput
+    logger.info("Loader autotune picked num_workers=%d prefetch_factor=%d", *best)
+    return best
+
+def get_transforms(img_size, mean=NORM_MEAN, std=NORM_STD, uint8=False, draft=False):
+    """
+    Train and test transforms. With `uint8` the images are returned as uint8 CHW tensors and
+    normalization is left to DevicePrefetcher (train) and valid() (test). With `draft` the
+    train crop is chosen before decoding and JPEGs are decoded at reduced resolution; this
+    needs a dataset that hands over undecoded images (ImageFolder with lazy_pil_loader).
+    """
+    if uint8:
+        to_tensor = [transforms.PILToTensor()]
+    else:
+        to_tensor = [transforms.ToTensor(), transforms.Normalize(mean=mean, std=std)]
+    if draft:
+        crop = DraftRandomResizedCrop(img_size, scale=(0.05, 1.0))
+    else:
+        crop = transforms.RandomResizedCrop((img_size, img_size), scale=(0.05, 1.0))
+    transform_train = transforms.Compose([crop] + to_tensor)
+    
+    transform_test = transforms.Compose([
+        transforms.Resize((img_size, img_size)),
+    ] + to_tensor)
+    return transform_train, transform_test
+
+def set_train_img_size(loader, img_size, **kwargs):
+    """
+    Switches the training transforms to `img_size`; takes effect when the next epoch starts.
+    `kwargs` are passed on to get_transforms().
+    """
+    loader.dataset.transform = get_transforms(img_size, **kwargs)[0]
+    restart_workers(loader)
+
 def get_loader(args):
     # only going to be using ImageNet-1K
     # ImageNet-21K will be used later on it needed
-    if args.local_rank not in [-1, 0]:
+    train_dir = os.path.join(args.data_root, 'train')
+    val_dir = os.path.join(args.data_root, 'val')
+    # Folder manifests can be loaded (or rebuilt) by every rank on its own; only the tar
+    # index and the eval cache are built once by rank 0 while the other ranks wait.
+    build_once = args.local_rank != -1 and (args.data_backend == "tar" or args.eval_cache is not None)
+    if build_once and args.local_rank != 0:
         torch.distributed.barrier()
     
-    transform_train = transforms.Compose([
-        transforms.RandomResizedCrop((args.img_size, args.img_size), scale=(0.05, 1.0)),
-        transforms.ToTensor(),
-        transforms.Normalize(mean=[0.5, 0.5, 0.5], std=[0.5, 0.5, 0.5])
-    ])
-    
-    transform_test = transforms.Compose([
-        transforms.Resize((args.img_size, args.img_size)),
-        transforms.ToTensor(),
-        transforms.Normalize(mean=[0.5, 0.5, 0.5], std=[0.5, 0.5, 0.5]),
-    ])
+    transform_train, transform_test = get_transforms(args.img_size, args.norm_mean, args.norm_std,
+                                                     uint8=args.device_normalize, draft=args.draft_decode)
     
-    trainset = datasets.ImageFolder('imagenet/train', transform=transform_train)
-    testset = datasets.ImageFolder('imagenet/val', transform=transform_test)
+    if args.data_backend == "tar":
+        # Images are read straight from the original train tar; rank 0 builds the index
+        trainset = TarImageDataset(args.train_tar, transform=transform_train)
+    elif args.data_backend == "shards":
+        # Shards written by make_shards.py, streamed sequentially
+        trainset = ShardedImageDataset(args.train_shards, transform=transform_train,
+                                       shuffle_buffer=args.shuffle_buffer, seed=args.seed)
+    else:
+        loader = lazy_pil_loader if args.draft_decode else datasets.folder.default_loader
+        trainset = ManifestImageFolder(train_dir, transform=transform_train, loader=loader)
+    if args.eval_cache is not None:
+        # Pre-resized uint8 images, normalized on the device in valid()
+        testset = EvalCacheDataset(build_eval_cache(val_dir, args.eval_cache, args.img_size,
+                                                    num_workers=args.num_workers))
+    else:
+        testset = ManifestImageFolder(val_dir, transform=transform_test)
     
-    if args.local_rank == 0:
+    if build_once and args.local_rank == 0:
         torch.distributed.barrier()
     
-    train_sampler = RandomSampler(trainset) if args.local_rank == -1 else DistributedSampler(trainset)
-    test_sampler = SequentialSampler(testset)
+    if args.data_backend == "shards":
+        train_sampler = None
+    elif args.local_rank == -1:
+        train_sampler = ResumableSampler(RandomSampler(trainset, generator=torch.Generator()), seed=args.seed)
+    else:
+        train_sampler = ResumableSampler(DistributedSampler(trainset, seed=args.seed), seed=args.seed)
+    # Validation is sharded across ranks as well; valid() drops the padding
+    # DistributedSampler adds to even out the shards.
+    test_sampler = SequentialSampler(testset) if args.local_rank == -1 else DistributedSampler(testset, shuffle=False)
+    if args.autotune_loader:
+        # Tuned on rank 0 only, so that ranks do not compete for the CPUs while measuring;
+        # all ranks then load with the same settings
+        tuned = [autotune_loader(trainset, train_sampler, args) if get_rank() == 0 else None]
+        if get_world_size() > 1:
+            dist.broadcast_object_list(tuned, src=0)
+        args.num_workers, args.prefetch_factor = tuned[0]
+    # prefetch_factor and persistent_workers may only be given when loading with worker processes
+    prefetch_factor = args.prefetch_factor if args.num_workers > 0 else None
+    persistent_workers = args.persistent_workers and args.num_workers > 0
     train_loader = DataLoader(trainset,
                               sampler=train_sampler,
                               batch_size=args.train_batch_size,
-                              num_workers=4,
-                              pin_memory=True)
+                              num_workers=args.num_workers,
+                              prefetch_factor=prefetch_factor,
+                              persistent_workers=persistent_workers,
+                              pin_memory=args.pin_memory)
+    # Cached eval batches are read as whole slices of the memmap and need no stacking
+    test_collate_fn = collate_eval_cache if args.eval_cache is not None else None
     test_loader = DataLoader(testset,
                              sampler=test_sampler,
                              batch_size=args.eval_batch_size,
-                             num_workers=4,
-                             pin_memory=True) if testset is not None else None
+                             num_workers=args.num_workers,
+                             prefetch_factor=prefetch_factor,
+                             persistent_workers=persistent_workers,
+                             pin_memory=args.pin_memory,
+                             collate_fn=test_collate_fn) if testset is not None else None
     
     return train_loader, test_loader
\ No newline at end of file
@@ -0,0 +1,153 @@
+import functools
+import hashlib
+import json
+import logging
+import os
+import shutil
+
+import numpy as np
+import torch
+
+from numpy.lib.format import open_memmap
+from torchvision import transforms, datasets
+from torch.utils.data import DataLoader, Dataset, default_collate
+
+from utils.manifest_dataset import dir_mtimes
+
+logger = logging.getLogger(__name__)
+
+def source_fingerprint(data_dir):
+    """
+    Hash of the class directories of `data_dir` and their mtimes, which change whenever files
+    are added, removed or renamed (as for the folder manifest), without a stat per image.
+    """
+    classes = sorted(entry.name for entry in os.scandir(data_dir) if entry.is_dir())
+    digest = hashlib.sha1(json.dumps(classes).encode())
+    digest.update(dir_mtimes(data_dir, classes).tobytes())
+    return digest.hexdigest()
+
+def cache_key(data_dir, img_size, resize_size=None):
+    """
+    Identifies a cached eval set by its source directory, a fingerprint of the files in it
+    and the deterministic transform, so that a changed eval set gets a new cache.
+    """
+    params = {"data_dir": os.path.abspath(data_dir), "source": source_fingerprint(data_dir),
+              "img_size": img_size, "resize_size": resize_size, "interpolation": "bilinear"}
+    return hashlib.sha1(json.dumps(params, sort_keys=True).encode()).hexdigest()[:16], params
+
+def get_cache_transform(img_size, resize_size=None):
+    """
+    Resize((img_size, img_size)) as in get_transforms(), or Resize(resize_size) followed by
+    CenterCrop(img_size) as in model_compare.py; images stay uint8.
+    """
+    if resize_size is None:
+        resize = [transforms.Resize((img_size, img_size))]
+    else:
+        resize = [transforms.Resize(resize_size), transforms.CenterCrop(img_size)]
+    return transforms.Compose(resize + [transforms.PILToTensor()])
+
+def build_eval_cache(data_dir, cache_root, img_size=224, resize_size=None, batch_size=256, num_workers=8):
+    """
+    Decodes and resizes an ImageFolder-style eval set once into
+    <cache_root>/<key>/images.npy, a uint8 (N, img_size, img_size, 3) array, plus labels.npy
+    and meta.json. The directory is written under a temporary name and renamed into place.
+    Returns the cache directory.
+    """
+    key, params = cache_key(data_dir, img_size, resize_size)
+    cache_dir = os.path.join(cache_root, key)
+    if os.path.exists(os.path.join(cache_dir, "meta.json")):
+        return cache_dir
+
+    dataset = datasets.ImageFolder(data_dir, transform=get_cache_transform(img_size, resize_size))
+    tmp_dir = cache_dir + ".tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    images = open_memmap(os.path.join(tmp_dir, "images.npy"), mode="w+", dtype=np.uint8,
+                         shape=(len(dataset), img_size, img_size, 3))
+    labels = np.asarray(dataset.targets, dtype=np.int64)
+    loader = DataLoader(dataset, batch_size=batch_size, shuffle=False, num_workers=num_workers)
+    offset = 0
+    for x, _ in loader:
+        images[offset:offset + x.size(0)] = x.permute(0, 2, 3, 1).numpy()
+        offset += x.size(0)
+    images.flush()
+    del images
+    np.save(os.path.join(tmp_dir, "labels.npy"), labels)
+    with open(os.path.join(tmp_dir, "meta.json"), "w") as f:
+        json.dump(dict(params, num_images=len(dataset), classes=dataset.classes), f)
+    os.replace(tmp_dir, cache_dir)
+    logger.info("Cached %d eval images from %s in %s", len(dataset), data_dir, cache_dir)
+    return cache_dir
+
+def _as_slice(indices):
+    """`indices` as a slice if they are evenly spaced and increasing, else None."""
+    if len(indices) == 1:
+        return slice(indices[0], indices[0] + 1)
+    step = indices[1] - indices[0]
+    if step <= 0 or any(b - a != step for a, b in zip(indices, indices[1:])):
+        return None
+    return slice(indices[0], indices[-1] + 1, step)
+
+class EvalCacheDataset(Dataset):
+    """
+    Serves a cache written by build_eval_cache(). Samples are uint8 CHW tensors read from
+    the memory-mapped array, so batches collate at a quarter of the float32 size; normalize
+    them on the device with normalize_batch().
+    Whole batches are read with `__getitems__`: evenly spaced indices (SequentialSampler,
+    DistributedSampler without shuffling) become one strided view of the memmap instead of
+    per-sample copies that are stacked again. Load it with `collate_fn=collate_eval_cache`.
+    """
+    def __init__(self, cache_dir):
+        with open(os.path.join(cache_dir, "meta.json")) as f:
+            self.meta = json.load(f)
+        # Copy-on-write, so that tensors can view the pages without a writable file
+        self.images = np.load(os.path.join(cache_dir, "images.npy"), mmap_mode="c")
+        self.labels = np.load(os.path.join(cache_dir, "labels.npy"))
+        self.classes = self.meta["classes"]
+        self.targets = self.labels.tolist()
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __getitem__(self, index):
+        img = torch.from_numpy(self.images[index]).permute(2, 0, 1)
+        return img, int(self.labels[index])
+
+    def __getitems__(self, indices):
+        """A collated (uint8 (B, 3, H, W), int64 (B,)) batch; see collate_eval_cache()."""
+        index = _as_slice(indices)
+        if index is None:
+            # Padded or shuffled batches take a single gather copy
+            index = np.asarray(indices)
+        images = torch.from_numpy(self.images[index]).permute(0, 3, 1, 2)
+        return images, torch.from_numpy(self.labels[index])
+
+def collate_eval_cache(batch):
+    """collate_fn for EvalCacheDataset: batches from `__getitems__` are passed through as is."""
+    if isinstance(batch, tuple):
+        return batch
+    return default_collate(batch)
+
+@functools.lru_cache(maxsize=None)
+def _normalization_stats(mean, std, device, dtype):
+    mean = torch.tensor(mean, device=device, dtype=dtype).view(1, -1, 1, 1) * 255
+    std = torch.tensor(std, device=device, dtype=dtype).view(1, -1, 1, 1) * 255
+    return mean, std
+
+def normalize_batch(images, mean, std, dtype=torch.float32):
+    """
+    Converts a uint8 (B, 3, H, W) batch to `dtype` and normalizes it, on the batch's device.
+    The mean/std tensors are built once per device and dtype.
+    """
+    mean, std = _normalization_stats(tuple(mean), tuple(std), images.device, dtype)
+    return (images.to(dtype) - mean) / std
+
+def attach_input_normalization(model, mean, std):
+    """
+    Normalizes uint8 inputs inside `model`'s forward with a pre-hook, so that callers that
+    only move batches to the device (e.g. CKA.compare) can use EvalCacheDataset as is.
+    """
+    def hook(module, args):
+        if args[0].dtype == torch.uint8:
+            return (normalize_batch(args[0], mean, std),) + tuple(args[1:])
+    return model.register_forward_pre_hook(hook)
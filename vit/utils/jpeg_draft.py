@@ -0,0 +1,41 @@
+import io
+
+from PIL import Image
+from torchvision import transforms
+
+def lazy_pil_loader(path):
+    """
+    Like torchvision's default loader, but returns the image with only its header parsed,
+    so that a later transform can still choose the JPEG decode scale with `Image.draft`.
+    """
+    with open(path, 'rb') as f:
+        return Image.open(io.BytesIO(f.read()))
+
+class DraftRandomResizedCrop(object):
+    """
+    RandomResizedCrop that picks the crop box before decoding. JPEGs are then decoded with
+    DCT-domain downscaling (1/2, 1/4 or 1/8) at the smallest scale at which the crop still
+    covers `size` pixels, and the crop is resized from that. The crop distribution is the
+    same as transforms.RandomResizedCrop. Images that are not JPEGs, or are already decoded,
+    take the full-resolution path.
+    """
+    def __init__(self, size, scale=(0.08, 1.0), ratio=(3. / 4., 4. / 3.), interpolation=Image.BILINEAR):
+        self.size = (size, size) if isinstance(size, int) else tuple(size)
+        self.scale = scale
+        self.ratio = ratio
+        self.interpolation = interpolation
+
+    def __call__(self, img):
+        width, height = img.size
+        top, left, h, w = transforms.RandomResizedCrop.get_params(img, self.scale, self.ratio)
+        # Largest reduction at which the crop is still at least the output size
+        reduction = min(w / self.size[1], h / self.size[0])
+        if reduction >= 2:
+            img.draft('RGB', (int(width / reduction), int(height / reduction)))
+        img = img.convert('RGB')
+        sx, sy = img.size[0] / width, img.size[1] / height
+        box = (left * sx, top * sy, (left + w) * sx, (top + h) * sy)
+        return img.resize((self.size[1], self.size[0]), self.interpolation, box=box)
+
+    def __repr__(self):
+        return "%s(size=%s, scale=%s, ratio=%s)" % (self.__class__.__name__, self.size, self.scale, self.ratio)
@@ -0,0 +1,93 @@
+import logging
+import os
+
+import numpy as np
+
+from torch.utils.data import Dataset
+from torchvision.datasets.folder import default_loader, IMG_EXTENSIONS
+
+logger = logging.getLogger(__name__)
+
+def dir_mtimes(root, classes):
+    """mtimes of `root` and its class directories; they change whenever files are added, removed or renamed."""
+    return np.asarray([os.stat(root).st_mtime_ns] +
+                      [os.stat(os.path.join(root, wnid)).st_mtime_ns for wnid in classes], dtype=np.int64)
+
+def build_manifest(root, manifest_path):
+    """
+    Walks an ImageFolder-style directory once and saves its (path, label) index as numpy
+    arrays: fixed-width unicode relative paths, int16 labels, the class names and the mtimes
+    of the root and class directories used to validate it. Classes and files are sorted as in
+    ImageFolder. Returns the manifest arrays.
+    """
+    classes = sorted(entry.name for entry in os.scandir(root) if entry.is_dir())
+    paths, labels = [], []
+    for label, wnid in enumerate(classes):
+        for entry in sorted(os.scandir(os.path.join(root, wnid)), key=lambda e: e.name):
+            if entry.name.lower().endswith(IMG_EXTENSIONS) and entry.is_file():
+                paths.append(wnid + "/" + entry.name)
+                labels.append(label)
+    # Unique temporary name: ranks that find no valid manifest may build it concurrently
+    tmp_path = "%s.%d.tmp.npz" % (manifest_path, os.getpid())
+    manifest = {"paths": np.asarray(paths, dtype=np.str_),
+                "labels": np.asarray(labels, dtype=np.int16),
+                "classes": np.asarray(classes, dtype=np.str_)}
+    np.savez(tmp_path, mtimes=dir_mtimes(root, classes), **manifest)
+    os.replace(tmp_path, manifest_path)
+    logger.info("Indexed %d images in %d classes from %s into %s", len(paths), len(classes), root, manifest_path)
+    return manifest
+
+def load_manifest(root, manifest_path):
+    """The manifest arrays, or None if it is missing, outdated or a directory changed since it was built."""
+    if not os.path.exists(manifest_path):
+        return None
+    manifest = np.load(manifest_path)
+    if manifest["paths"].dtype.kind != "U":
+        # Written with ASCII-only byte paths by an earlier version
+        return None
+    classes = manifest["classes"].tolist()
+    try:
+        mtimes = dir_mtimes(root, classes)
+    except FileNotFoundError:
+        return None
+    if not np.array_equal(mtimes, manifest["mtimes"]):
+        return None
+    return {key: manifest[key] for key in ("paths", "labels", "classes")}
+
+class ManifestImageFolder(Dataset):
+    """
+    Drop-in for `datasets.ImageFolder` that keeps its file index in a manifest next to the
+    root (<root>.manifest.npz) instead of walking every class directory on each launch.
+    The manifest is checked against the mtimes of the root and class directories, which
+    change whenever files are added, removed or renamed, and rebuilt if stale. Every rank
+    can load it independently, so no barrier is needed.
+    """
+    def __init__(self, root, transform=None, loader=default_loader, manifest_path=None):
+        self.root = root
+        self.transform = transform
+        self.loader = loader
+        self.manifest_path = manifest_path or os.path.normpath(root) + ".manifest.npz"
+
+        manifest = load_manifest(root, self.manifest_path)
+        if manifest is None:
+            # Use the arrays just built: another rank may replace the file or a directory may
+            # change in between, and reloading would then find it stale again
+            manifest = build_manifest(root, self.manifest_path)
+        self.paths = manifest["paths"]
+        self.labels = manifest["labels"]
+        self.classes = manifest["classes"].tolist()
+        self.class_to_idx = {wnid: idx for idx, wnid in enumerate(self.classes)}
+
+    @property
+    def targets(self):
+        return self.labels.tolist()
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __getitem__(self, index):
+        path = os.path.join(self.root, self.paths[index])
+        img = self.loader(path)
+        if self.transform is not None:
+            img = self.transform(img)
+        return img, int(self.labels[index])
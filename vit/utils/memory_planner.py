@@ -0,0 +1,135 @@
+import logging
+import math
+
+import torch
+import torch.distributed as dist
+
+from utils.dist_util import get_world_size
+
+logger = logging.getLogger(__name__)
+
+# Bytes per activation element; model weights, gradients and SGD momentum stay in fp32
+ACTIVATION_BYTES = {"fp32": 4, "fp16": 2, "bf16": 2}
+
+class StepEstimate(object):
+    """Analytic memory (bytes) and FLOPs of one training step of a ViT config."""
+    def __init__(self, config, img_size=224, precision="fp32", checkpointing=False, num_classes=1000):
+        D = config.hidden_size
+        M = config.transformer["mlp_dim"]
+        H = config.transformer["num_heads"]
+        L = config.transformer["num_layers"]
+        P = config.patches["size"][0]
+        N = (img_size // P) ** 2 + 1
+        act_bytes = ACTIVATION_BYTES[precision]
+
+        block_params = 4 * (D * D + D) + (D * M + M) + (M * D + D) + 4 * D
+        self.num_params = (3 * P * P * D + D) + N * D + D + L * block_params + 2 * D + D * num_classes + num_classes
+
+        # Weights and gradients (fp32) plus the SGD momentum buffer; autocast keeps a half copy
+        self.param_bytes = self.num_params * (12 + (2 if precision != "fp32" else 0))
+
+        # Tensors saved for backward per sample in one Block: the two LayerNorm inputs and
+        # outputs, q, k, v, the attention context and the (H, N, N) attention probabilities,
+        # the MLP hidden before and after GELU, and one byte per element for dropout masks.
+        block_elements = 9 * N * D + H * N * N + 2 * N * M
+        mask_bytes = (N * M + 2 * N * D) if config.transformer["dropout_rate"] > 0 else 0
+        if config.transformer["attention_dropout_rate"] > 0:
+            block_elements += H * N * N
+            mask_bytes += H * N * N
+        block_bytes = block_elements * act_bytes + mask_bytes
+        if checkpointing:
+            # Only the block inputs are kept; one block is recomputed at a time in backward
+            self.activation_bytes_per_sample = L * N * D * act_bytes + block_bytes
+        else:
+            self.activation_bytes_per_sample = L * block_bytes
+        # Patch embedding input/output and the final LayerNorm
+        self.activation_bytes_per_sample += (3 * img_size * img_size + 3 * N * D) * act_bytes
+
+        block_flops = 2 * N * (4 * D * D + 2 * D * M) + 4 * N * N * D
+        forward_flops = L * block_flops + 2 * (N - 1) * 3 * P * P * D + 2 * D * num_classes
+        # Backward costs about twice the forward; checkpointing adds one more forward
+        self.flops_per_sample = forward_flops * (4 if checkpointing else 3)
+
+    def memory(self, micro_batch):
+        return self.param_bytes + micro_batch * self.activation_bytes_per_sample
+
+    def max_micro_batch(self, memory_budget):
+        return max(0, int((memory_budget - self.param_bytes) // self.activation_bytes_per_sample))
+
+
+def probe_peak_memory(model, micro_batch, img_size, device, num_classes=1000):
+    """Peak CUDA memory of one forward+backward at `micro_batch`; None if it does not fit or not on CUDA."""
+    if device.type != "cuda":
+        return None
+    model.train()
+    torch.cuda.empty_cache()
+    torch.cuda.reset_peak_memory_stats(device)
+    try:
+        x = torch.randn(micro_batch, 3, img_size, img_size, device=device)
+        y = torch.randint(0, num_classes, (micro_batch,), device=device)
+        model(x, y).backward()
+        torch.cuda.synchronize(device)
+        peak = torch.cuda.max_memory_allocated(device)
+    except torch.cuda.OutOfMemoryError:
+        peak = None
+    model.zero_grad(set_to_none=True)
+    torch.cuda.empty_cache()
+    return peak
+
+
+def plan_batch(config, img_size, target_batch, memory_budget, precision="fp32", checkpointing=False,
+               model=None, device=None, num_classes=1000):
+    """
+    Picks the largest micro-batch that fits `memory_budget` bytes and the number of gradient
+    accumulation steps needed to reach `target_batch` samples per optimization step.
+    If a model on a CUDA device is given, the estimate is checked with a short probe run and
+    the per-sample activation size is corrected by the measured peak memory; a larger
+    micro-batch extrapolated from that is probed again before it is used.
+    Under DDP every rank must call it: ranks can measure different peaks, so the smallest
+    micro-batch of all ranks is used, and all ranks accumulate the same number of steps.
+    Returns (micro_batch, accumulation_steps, StepEstimate).
+    """
+    estimate = StepEstimate(config, img_size, precision, checkpointing, num_classes)
+    micro_batch = min(target_batch, estimate.max_micro_batch(memory_budget))
+    if micro_batch < 1:
+        raise ValueError("Parameters and optimizer state alone need %.1f GB, more than the %.1f GB budget"
+                         % (estimate.param_bytes / 1024 ** 3, memory_budget / 1024 ** 3))
+
+    if model is not None and device is not None and device.type == "cuda":
+        while micro_batch >= 1:
+            peak = probe_peak_memory(model, micro_batch, img_size, device, num_classes)
+            if peak is not None:
+                break
+            micro_batch //= 2
+        if peak is None:
+            raise ValueError("A single sample does not fit on %s" % device)
+        # The probe holds weights and gradients but no optimizer state yet
+        measured = (peak - estimate.num_params * 8) / micro_batch
+        logger.info("Probe at micro-batch %d: peak %.2f GB, estimated %.2f GB"
+                    % (micro_batch, peak / 1024 ** 3, estimate.memory(micro_batch) / 1024 ** 3))
+        if measured > 0:
+            estimate.activation_bytes_per_sample = measured
+            probed = micro_batch
+            micro_batch = min(target_batch, max(1, estimate.max_micro_batch(memory_budget)))
+            # Confirm the extrapolated size, backing off towards the size that was measured
+            while micro_batch > probed:
+                peak = probe_peak_memory(model, micro_batch, img_size, device, num_classes)
+                # The probe runs without the optimizer's momentum buffer
+                if peak is not None and peak + estimate.num_params * 4 <= memory_budget:
+                    break
+                micro_batch = (micro_batch + probed) // 2
+
+    if get_world_size() > 1:
+        smallest = torch.tensor(micro_batch, device=device if device is not None else "cpu")
+        dist.all_reduce(smallest, op=dist.ReduceOp.MIN)
+        micro_batch = int(smallest.item())
+
+    accumulation_steps = math.ceil(target_batch / micro_batch)
+    # Spread the target evenly over the accumulation steps
+    micro_batch = math.ceil(target_batch / accumulation_steps)
+    logger.info("Memory plan: micro-batch %d x %d accumulation steps, %.2f GB estimated, "
+                "%.2f TFLOPs per optimization step (%.1f GFLOPs per sample)"
+                % (micro_batch, accumulation_steps, estimate.memory(micro_batch) / 1024 ** 3,
+                   estimate.flops_per_sample * micro_batch * accumulation_steps / 1e12,
+                   estimate.flops_per_sample / 1e9))
+    return micro_batch, accumulation_steps, estimate
@@ -0,0 +1,163 @@
+import logging
+import os
+import resource
+import time
+
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+from functools import partial
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+class StepProfiler(object):
+    """
+    Opt-in, sampled profiling of the training loop.
+    Every `every` optimization steps, the data loader wait, forward (split into embeddings,
+    attention and MLP), backward, gradient clipping and optimizer phases are timed, together
+    with the forward and backward time of every encoder `Block` and the peak memory, and
+    written to TensorBoard under "profile/". With gradient checkpointing, the forward re-run
+    of a block during backward is not counted as forward time (it is part of the block's
+    backward time). On the GPU the peak memory is that of the step; on the CPU only the
+    process' lifetime peak RSS is available and is logged as "profile/peak_rss_mb". The module hooks are only installed for the sampled
+    steps, so the other steps run the model unchanged (full backward hooks in particular wrap
+    the inputs and outputs of every block).
+    Optionally the steps in `trace_steps` (first, last) are recorded as a Chrome trace.
+    With `every` <= 0 and no trace window the profiler does nothing.
+    """
+    def __init__(self, model, writer=None, every=0, trace_dir=None, trace_steps=None):
+        self.writer = writer
+        self.every = every
+        self.trace_dir = trace_dir
+        self.trace_steps = trace_steps
+        self.enabled = every > 0 or trace_steps is not None
+        self.active = False
+        self.step = None
+        self.times = defaultdict(float)
+        self._starts = {}
+        self._handles = []
+        self._trace = None
+        self._cuda = torch.cuda.is_available()
+        self._model = model.module if hasattr(model, 'module') else model
+
+    def _sync(self):
+        if self._cuda:
+            torch.cuda.synchronize()
+
+    def _start(self, key, *args):
+        if self.active:
+            self._sync()
+            self._starts[key] = time.perf_counter()
+
+    def _stop(self, key, *args):
+        if self.active and key in self._starts:
+            self._sync()
+            self.times[key] += time.perf_counter() - self._starts.pop(key)
+
+    def _recomputing(self):
+        return getattr(self._model.transformer.encoder, "recomputing", False)
+
+    def _start_forward(self, key, *args):
+        if not self._recomputing():
+            self._start(key)
+
+    def _stop_forward(self, key, *args):
+        if not self._recomputing():
+            self._stop(key)
+
+    def _register_hooks(self, model):
+        transformer = model.transformer
+        self._handles.append(transformer.embeddings.register_forward_pre_hook(partial(self._start, "embeddings")))
+        self._handles.append(transformer.embeddings.register_forward_hook(partial(self._stop, "embeddings")))
+        for idx, block in enumerate(transformer.encoder.layer):
+            for name, module in (("attention", block.attn), ("mlp", block.ffn)):
+                key = "%s/%d" % (name, idx)
+                self._handles.append(module.register_forward_pre_hook(partial(self._start_forward, key)))
+                self._handles.append(module.register_forward_hook(partial(self._stop_forward, key)))
+            key = "block_%d/forward" % idx
+            self._handles.append(block.register_forward_pre_hook(partial(self._start_forward, key)))
+            self._handles.append(block.register_forward_hook(partial(self._stop_forward, key)))
+            key = "block_%d/backward" % idx
+            self._handles.append(block.register_full_backward_pre_hook(partial(self._start, key)))
+            self._handles.append(block.register_full_backward_hook(partial(self._stop, key)))
+
+    def start_step(self, step):
+        """Called before every micro-batch of optimization step `step`."""
+        if not self.enabled or step == self.step:
+            return
+        self.step = step
+        self._remove_hooks()
+        self.active = self.every > 0 and step % self.every == 0
+        if self.active:
+            self.times.clear()
+            self._register_hooks(self._model)
+            if self._cuda:
+                torch.cuda.reset_peak_memory_stats()
+        if self.trace_steps is not None and step == self.trace_steps[0]:
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if self._cuda:
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self._trace = torch.profiler.profile(activities=activities, profile_memory=True)
+            self._trace.__enter__()
+
+    def add(self, name, seconds):
+        if self.active:
+            self.times[name] += seconds
+
+    @contextmanager
+    def phase(self, name):
+        if not self.enabled:
+            yield
+            return
+        record = torch.profiler.record_function(name) if self._trace is not None else nullcontext()
+        with record:
+            self._start(name)
+            try:
+                yield
+            finally:
+                self._stop(name)
+
+    def end_step(self):
+        """Called after the optimizer step; writes the sampled timings."""
+        if not self.enabled:
+            return
+        if self.active and self.writer is not None:
+            totals = defaultdict(float)
+            for key, seconds in self.times.items():
+                if key.startswith(("attention/", "mlp/")):
+                    totals[key.split("/")[0]] += seconds
+                self.writer.add_scalar("profile/%s" % key, scalar_value=seconds * 1000.0, global_step=self.step)
+            for key, seconds in totals.items():
+                self.writer.add_scalar("profile/%s" % key, scalar_value=seconds * 1000.0, global_step=self.step)
+            if self._cuda:
+                self.writer.add_scalar("profile/peak_memory_mb",
+                                       scalar_value=torch.cuda.max_memory_allocated() / 1024 ** 2,
+                                       global_step=self.step)
+            else:
+                # ru_maxrss (KB on Linux) is the peak since the process started, not per step
+                self.writer.add_scalar("profile/peak_rss_mb",
+                                       scalar_value=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0,
+                                       global_step=self.step)
+        self.active = False
+        self._remove_hooks()
+        if self._trace is not None and self.step == self.trace_steps[1]:
+            self._finish_trace()
+
+    def _finish_trace(self):
+        if self._trace is not None:
+            self._trace.__exit__(None, None, None)
+            os.makedirs(self.trace_dir, exist_ok=True)
+            path = os.path.join(self.trace_dir, "trace_steps_%d-%d.json" % tuple(self.trace_steps))
+            self._trace.export_chrome_trace(path)
+            logger.info("Wrote Chrome trace to %s", path)
+            self._trace = None
+
+    def _remove_hooks(self):
+        for handle in self._handles:
+            handle.remove()
+        self._handles = []
+
+    def close(self):
+        self._finish_trace()
+        self._remove_hooks()
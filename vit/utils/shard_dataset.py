@@ -0,0 +1,137 @@
+import io
+import json
+import os
+import random
+import tarfile
+
+from PIL import Image
+from torch.utils.data import IterableDataset, get_worker_info
+
+from utils.dist_util import get_rank, get_world_size
+
+SHARD_INDEX = "shards.json"
+
+def read_shard(path):
+    """Yields (image bytes, label) pairs of one shard in file order."""
+    with tarfile.open(path, 'r|') as tar:
+        data = None
+        for member in tar:
+            if not member.isfile():
+                continue
+            if member.name.endswith(".cls"):
+                yield data, int(tar.extractfile(member).read())
+            else:
+                data = tar.extractfile(member).read()
+
+def write_shard(path, samples, offset=0):
+    """
+    Writes `samples` [(image path, label)] into one tar shard: every sample is stored as
+    <key>.<ext> followed by <key>.cls holding the class index. The shard is written to a
+    temporary name and renamed into place.
+    """
+    tmp_path = path + ".tmp"
+    with tarfile.open(tmp_path, 'w') as tar:
+        for idx, (image_path, label) in enumerate(samples):
+            key = "%09d" % (offset + idx)
+            tar.add(image_path, arcname=key + os.path.splitext(image_path)[1].lower())
+            cls = str(label).encode()
+            info = tarfile.TarInfo(key + ".cls")
+            info.size = len(cls)
+            tar.addfile(info, io.BytesIO(cls))
+    os.replace(tmp_path, path)
+    return path
+
+class ShardedImageDataset(IterableDataset):
+    """
+    Streams samples from tar shards written by make_shards.py, reading each shard
+    sequentially instead of opening one small file per sample.
+    Every epoch the shard order is shuffled, and the resulting stream of samples is cut into
+    contiguous, equally long ranges, first per DDP rank and then per DataLoader worker. A
+    worker only reads the shards overlapping its range, and every sample is yielded exactly
+    once per epoch (the last total % world_size samples are dropped, so that DDP ranks stay in
+    step). Samples pass through an in-memory shuffle buffer of `shuffle_buffer` encoded images
+    per worker.
+    """
+    def __init__(self, shard_dir, transform=None, shuffle=True, shuffle_buffer=1000, seed=0):
+        with open(os.path.join(shard_dir, SHARD_INDEX)) as f:
+            index = json.load(f)
+        self.shards = [os.path.join(shard_dir, name) for name in index["shards"]]
+        self.shard_sizes = index["sizes"]
+        self.classes = index["classes"]
+        self.class_to_idx = {wnid: idx for idx, wnid in enumerate(self.classes)}
+        self.transform = transform
+        self.shuffle = shuffle
+        self.shuffle_buffer = shuffle_buffer
+        self.seed = seed
+        self.epoch = 0
+        self.start_index = 0
+        self.rank = get_rank()
+        self.world_size = get_world_size()
+        self.num_samples = sum(self.shard_sizes) // self.world_size
+
+    def set_epoch(self, epoch, start_index=0):
+        """
+        Starts `epoch`. `start_index` samples of this rank are skipped, split evenly over the
+        workers; with several workers the resumed position is therefore approximate.
+        """
+        self.epoch = epoch
+        self.start_index = start_index
+
+    def __len__(self):
+        return self.num_samples
+
+    def _sample_range(self, order, start, stop):
+        """Yields the samples [start, stop) of the stream of the shards in `order`."""
+        offset = 0
+        for shard_idx in order:
+            if offset >= stop:
+                break
+            size = self.shard_sizes[shard_idx]
+            if offset + size > start:
+                for position, sample in enumerate(read_shard(self.shards[shard_idx]), offset):
+                    if position >= stop:
+                        break
+                    if position >= start:
+                        yield sample
+            offset += size
+
+    def _shuffled(self, samples, rng, buffer_size):
+        buffer = []
+        for sample in samples:
+            if buffer_size == 0:
+                yield sample
+                continue
+            if len(buffer) < buffer_size:
+                buffer.append(sample)
+                continue
+            idx = rng.randrange(len(buffer))
+            yield buffer[idx]
+            buffer[idx] = sample
+        rng.shuffle(buffer)
+        while buffer:
+            yield buffer.pop()
+
+    def __iter__(self):
+        rng = random.Random(self.seed + self.epoch)
+        order = list(range(len(self.shards)))
+        if self.shuffle:
+            rng.shuffle(order)
+        worker_info = get_worker_info()
+        worker_id, num_workers = (worker_info.id, worker_info.num_workers) if worker_info is not None else (0, 1)
+
+        rank_start = self.rank * self.num_samples
+        start = rank_start + worker_id * self.num_samples // num_workers
+        stop = rank_start + (worker_id + 1) * self.num_samples // num_workers
+        skip = self.start_index // num_workers
+
+        # The buffer of each worker is seeded differently so that workers do not mirror each other
+        rng = random.Random((self.seed + self.epoch) * 1000003 + self.rank * 1009 + worker_id)
+        buffer_size = self.shuffle_buffer if self.shuffle else 0
+        samples = self._shuffled(self._sample_range(order, start, stop), rng, buffer_size)
+        for idx, (data, label) in enumerate(samples):
+            if idx < skip:
+                continue
+            img = Image.open(io.BytesIO(data)).convert('RGB')
+            if self.transform is not None:
+                img = self.transform(img)
+            yield img, label
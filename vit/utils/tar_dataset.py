@@ -0,0 +1,111 @@
+import io
+import logging
+import os
+import tarfile
+
+import numpy as np
+
+from PIL import Image
+from torch.utils.data import Dataset
+
+logger = logging.getLogger(__name__)
+
+IMG_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.ppm', '.bmp', '.pgm', '.tif', '.tiff', '.webp')
+
+def _is_image(name):
+    return name.lower().endswith(IMG_EXTENSIONS)
+
+def build_tar_index(tar_path, index_path):
+    """
+    Indexes a tar of images in one streaming pass and saves a sidecar .npz holding, for
+    every image, its byte offset and size inside `tar_path` and its class index.
+    Either the ILSVRC2012 train layout (one <wnid>.tar of images per class inside the outer
+    tar) or a tar of <wnid>/<image> folders. Classes are numbered in sorted order, as in ImageFolder.
+    """
+    offsets, sizes, wnids = [], [], []
+    with tarfile.open(tar_path, 'r|') as tar:
+        for member in tar:
+            if not member.isfile():
+                continue
+            if member.name.endswith(".tar"):
+                wnid = os.path.basename(member.name)[:-4]
+                # Offsets inside the class tar are relative to where its data starts in the outer tar
+                with tarfile.open(fileobj=io.BytesIO(tar.extractfile(member).read()), mode='r:') as inner:
+                    for inner_member in inner:
+                        if inner_member.isfile() and _is_image(inner_member.name):
+                            offsets.append(member.offset_data + inner_member.offset_data)
+                            sizes.append(inner_member.size)
+                            wnids.append(wnid)
+            elif _is_image(member.name) and "/" in member.name.strip("./"):
+                offsets.append(member.offset_data)
+                sizes.append(member.size)
+                wnids.append(member.name.strip("./").split("/")[-2])
+
+    classes = sorted(set(wnids))
+    class_to_idx = {wnid: idx for idx, wnid in enumerate(classes)}
+    stat = os.stat(tar_path)
+    tmp_path = index_path + ".tmp.npz"
+    np.savez(tmp_path,
+             offsets=np.asarray(offsets, dtype=np.int64),
+             sizes=np.asarray(sizes, dtype=np.int32),
+             labels=np.asarray([class_to_idx[w] for w in wnids], dtype=np.int16),
+             classes=np.asarray(classes),
+             tar_size=stat.st_size,
+             tar_mtime=stat.st_mtime)
+    os.replace(tmp_path, index_path)
+    logger.info("Indexed %d images in %d classes from %s", len(offsets), len(classes), tar_path)
+
+class TarImageDataset(Dataset):
+    """
+    Map-style dataset that reads images straight out of an (uncompressed) tar, without
+    extracting it. The tar is indexed once into a sidecar `<tar>.index.npz`, which is rebuilt
+    when the tar changes; samples are then read with a single `os.pread` each.
+    Exposes `classes`, `class_to_idx` and `targets` like `datasets.ImageFolder`.
+    """
+    def __init__(self, tar_path, transform=None, index_path=None):
+        self.tar_path = tar_path
+        self.transform = transform
+        self.index_path = index_path or tar_path + ".index.npz"
+
+        stat = os.stat(tar_path)
+        index = np.load(self.index_path) if os.path.exists(self.index_path) else None
+        if index is None or int(index["tar_size"]) != stat.st_size or float(index["tar_mtime"]) != stat.st_mtime:
+            build_tar_index(tar_path, self.index_path)
+            index = np.load(self.index_path)
+        self.offsets = index["offsets"]
+        self.sizes = index["sizes"]
+        self.labels = index["labels"]
+        self.classes = index["classes"].tolist()
+        self.class_to_idx = {wnid: idx for idx, wnid in enumerate(self.classes)}
+        self._fd = None
+        self._pid = None
+
+    @property
+    def targets(self):
+        return self.labels.tolist()
+
+    def _file(self):
+        # DataLoader workers are forked: each process opens its own descriptor
+        if self._fd is None or self._pid != os.getpid():
+            self._fd = os.open(self.tar_path, os.O_RDONLY)
+            self._pid = os.getpid()
+        return self._fd
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_fd"] = None
+        return state
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, index):
+        data = os.pread(self._file(), int(self.sizes[index]), int(self.offsets[index]))
+        img = Image.open(io.BytesIO(data)).convert('RGB')
+        if self.transform is not None:
+            img = self.transform(img)
+        return img, int(self.labels[index])
+
+    def __del__(self):
+        if self._fd is not None and self._pid == os.getpid():
+            os.close(self._fd)
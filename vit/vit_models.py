@@ -2,18 +2,23 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
-import copy
 import logging
 import math
+import re
+import time
 
+from collections import OrderedDict
 from os.path import join as pjoin
 
 import torch
 import torch.nn as nn
 import numpy as np
 
+import torch.nn.functional as F
+
 from torch.nn import CrossEntropyLoss, Dropout, Softmax, Linear, Conv2d, LayerNorm
 from torch.nn.modules.utils import _pair
+from torch.utils.checkpoint import checkpoint
 from scipy import ndimage
 
 import configs
@@ -63,6 +68,9 @@ class Attention(nn.Module):
         self.proj_dropout = Dropout(config.transformer["attention_dropout_rate"])
 
         self.softmax = Softmax(dim=-1)
+        # Streaming statistics over the attention probabilities, see attention_stats.py
+        self.layer_idx = None
+        self.reducers = []
 
     def transpose_for_scores(self, x):
         new_x_shape = x.size()[:-1] + (self.num_attention_heads, self.attention_head_size)
@@ -81,6 +89,8 @@ class Attention(nn.Module):
         attention_scores = torch.matmul(query_layer, key_layer.transpose(-1, -2))
         attention_scores = attention_scores / math.sqrt(self.attention_head_size)
         attention_probs = self.softmax(attention_scores)
+        for reducer in self.reducers:
+            reducer.update(self.layer_idx, attention_probs.detach())
         weights = attention_probs if self.vis else None
         attention_probs = self.attn_dropout(attention_probs)
 
@@ -130,10 +140,12 @@ class Embeddings(nn.Module):
             grid_size = config.patches["grid"]
             patch_size = (img_size[0] // 16 // grid_size[0], img_size[1] // 16 // grid_size[1])
             n_patches = (img_size[0] // 16) * (img_size[1] // 16)
+            self.grid_size = (img_size[0] // 16, img_size[1] // 16)
             self.hybrid = True
         else:
             patch_size = _pair(config.patches["size"])
             n_patches = (img_size[0] // patch_size[0]) * (img_size[1] // patch_size[1])
+            self.grid_size = (img_size[0] // patch_size[0], img_size[1] // patch_size[1])
             self.hybrid = False
 
         if self.hybrid:
@@ -148,6 +160,29 @@ class Embeddings(nn.Module):
         self.cls_token = nn.Parameter(torch.zeros(1, 1, config.hidden_size))
 
         self.dropout = Dropout(config.transformer["dropout_rate"])
+        self._interpolation_cache = {}
+
+    def interpolation_matrix(self, grid_size, device, dtype):
+        """
+        Returns the (new_tokens, old_tokens) matrix that bicubically resizes the position
+        embedding grid to `grid_size`. Interpolation is linear in its input, so the matrix is
+        built once per resolution and applied with a matmul that gradients flow through.
+        """
+        key = (grid_size, device, dtype)
+        if key not in self._interpolation_cache:
+            n_old = self.grid_size[0] * self.grid_size[1]
+            eye = torch.eye(n_old, device=device, dtype=dtype).reshape(n_old, 1, *self.grid_size)
+            weights = F.interpolate(eye, size=grid_size, mode="bicubic", align_corners=False)
+            self._interpolation_cache[key] = weights.reshape(n_old, -1).t().contiguous()
+        return self._interpolation_cache[key]
+
+    def get_position_embeddings(self, grid_size):
+        if grid_size == self.grid_size:
+            return self.position_embeddings
+        posemb = self.position_embeddings
+        weights = self.interpolation_matrix(grid_size, posemb.device, posemb.dtype)
+        posemb_grid = torch.matmul(weights, posemb[0, 1:]).unsqueeze(0)
+        return torch.cat((posemb[:, :1], posemb_grid), dim=1)
 
     def forward(self, x):
         B = x.shape[0]
@@ -156,15 +191,36 @@ class Embeddings(nn.Module):
         if self.hybrid:
             x = self.hybrid_model(x)
         x = self.patch_embeddings(x)
+        grid_size = tuple(x.shape[-2:])
         x = x.flatten(2)
         x = x.transpose(-1, -2)
         x = torch.cat((cls_tokens, x), dim=1)
 
-        embeddings = x + self.position_embeddings
+        # Inputs at a different resolution than img_size (e.g. progressive resizing)
+        # get position embeddings interpolated to their patch grid
+        embeddings = x + self.get_position_embeddings(grid_size)
         embeddings = self.dropout(embeddings)
         return embeddings
 
 
+class TokenDropout(nn.Module):
+    """Randomly keeps the CLS token plus a fraction of the patch tokens of every sample during training.
+    """
+    def __init__(self, keep_ratio=1.0):
+        super(TokenDropout, self).__init__()
+        self.keep_ratio = keep_ratio
+
+    def forward(self, x):
+        if not self.training or self.keep_ratio >= 1.0:
+            return x
+        B, N, D = x.shape
+        num_keep = max(1, int(round((N - 1) * self.keep_ratio)))
+        # Independent random subset per sample: top-k of uniform noise
+        keep = torch.rand(B, N - 1, device=x.device).topk(num_keep, dim=1).indices + 1
+        patches = torch.gather(x, 1, keep.unsqueeze(-1).expand(-1, -1, D))
+        return torch.cat((x[:, :1], patches), dim=1)
+
+
 class Block(nn.Module):
     def __init__(self, config, vis):
         super(Block, self).__init__()
@@ -229,16 +285,45 @@ class Encoder(nn.Module):
     def __init__(self, config, vis):
         super(Encoder, self).__init__()
         self.vis = vis
+        # Recompute block activations in backward instead of storing them (training only)
+        self.gradient_checkpointing = False
+        # True while checkpoint() re-runs a block's forward during backward
+        self.recomputing = False
         self.layer = nn.ModuleList()
         self.encoder_norm = LayerNorm(config.hidden_size, eps=1e-6)
-        for _ in range(config.transformer["num_layers"]):
-            layer = Block(config, vis)
-            self.layer.append(copy.deepcopy(layer))
+        for i in range(config.transformer["num_layers"]):
+            self.layer.append(Block(config, vis))
+            self.layer[i].attn.layer_idx = i
+
+    def add_attention_reducer(self, reducer):
+        """Feeds every layer's attention probabilities to `reducer` during the forward pass."""
+        for layer_block in self.layer:
+            layer_block.attn.reducers.append(reducer)
+
+    def remove_attention_reducer(self, reducer):
+        for layer_block in self.layer:
+            layer_block.attn.reducers.remove(reducer)
+
+    def _checkpointed(self, layer_block, hidden_states):
+        calls = []
+
+        def run(hidden_states):
+            # The first call is the forward pass, any later one the recompute in backward
+            self.recomputing = bool(calls)
+            calls.append(None)
+            try:
+                return layer_block(hidden_states)
+            finally:
+                self.recomputing = False
+        return checkpoint(run, hidden_states, use_reentrant=False)
 
     def forward(self, hidden_states):
         attn_weights = []
         for layer_block in self.layer:
-            hidden_states, weights = layer_block(hidden_states)
+            if self.gradient_checkpointing and self.training and torch.is_grad_enabled():
+                hidden_states, weights = self._checkpointed(layer_block, hidden_states)
+            else:
+                hidden_states, weights = layer_block(hidden_states)
             if self.vis:
                 attn_weights.append(weights)
         encoded = self.encoder_norm(hidden_states)
@@ -246,25 +331,27 @@ class Encoder(nn.Module):
 
 
 class Transformer(nn.Module):
-    def __init__(self, config, img_size, vis):
+    def __init__(self, config, img_size, vis, token_keep_ratio=1.0):
         super(Transformer, self).__init__()
         self.embeddings = Embeddings(config, img_size=img_size)
+        self.token_dropout = TokenDropout(token_keep_ratio)
         self.encoder = Encoder(config, vis)
 
     def forward(self, input_ids):
         embedding_output = self.embeddings(input_ids)
+        embedding_output = self.token_dropout(embedding_output)
         encoded, attn_weights = self.encoder(embedding_output)
         return encoded, attn_weights
 
 
 class VisionTransformer(nn.Module):
-    def __init__(self, config, img_size=224, num_classes=21843, zero_head=False, vis=False):
+    def __init__(self, config, img_size=224, num_classes=21843, zero_head=False, vis=False, token_keep_ratio=1.0):
         super(VisionTransformer, self).__init__()
         self.num_classes = num_classes
         self.zero_head = zero_head
         self.classifier = config.classifier
 
-        self.transformer = Transformer(config, img_size, vis)
+        self.transformer = Transformer(config, img_size, vis, token_keep_ratio)
         self.head = Linear(config.hidden_size, num_classes)
 
     def forward(self, x, labels=None):
@@ -295,28 +382,9 @@ class VisionTransformer(nn.Module):
 
             posemb = np2th(weights["Transformer/posembed_input/pos_embedding"])
             posemb_new = self.transformer.embeddings.position_embeddings
-            if posemb.size() == posemb_new.size():
-                self.transformer.embeddings.position_embeddings.copy_(posemb)
-            else:
-                logger.info("load_pretrained: resized variant: %s to %s" % (posemb.size(), posemb_new.size()))
-                ntok_new = posemb_new.size(1)
-
-                if self.classifier == "token":
-                    posemb_tok, posemb_grid = posemb[:, :1], posemb[0, 1:]
-                    ntok_new -= 1
-                else:
-                    posemb_tok, posemb_grid = posemb[:, :0], posemb[0]
-
-                gs_old = int(np.sqrt(len(posemb_grid)))
-                gs_new = int(np.sqrt(ntok_new))
-                print('load_pretrained: grid-size from %s to %s' % (gs_old, gs_new))
-                posemb_grid = posemb_grid.reshape(gs_old, gs_old, -1)
-
-                zoom = (gs_new / gs_old, gs_new / gs_old, 1)
-                posemb_grid = ndimage.zoom(posemb_grid, zoom, order=1)
-                posemb_grid = posemb_grid.reshape(1, gs_new * gs_new, -1)
-                posemb = np.concatenate([posemb_tok, posemb_grid], axis=1)
-                self.transformer.embeddings.position_embeddings.copy_(np2th(posemb))
+            if posemb.size() != posemb_new.size():
+                posemb = resize_pos_embed(posemb, posemb_new.size(1), self.classifier)
+            self.transformer.embeddings.position_embeddings.copy_(posemb)
 
             for bname, block in self.transformer.encoder.named_children():
                 for uname, unit in block.named_children():
@@ -334,7 +402,113 @@ class VisionTransformer(nn.Module):
                         unit.load_from(weights, n_block=bname, n_unit=uname)
 
 
+def resize_pos_embed(posemb, ntok_new, classifier="token"):
+    """Resizes (1, N, D) position embeddings to `ntok_new` tokens by zooming the patch grid."""
+    logger.info("load_pretrained: resized variant: %s to %s" % (tuple(posemb.size()), ntok_new))
+    posemb = posemb.numpy()
+    if classifier == "token":
+        posemb_tok, posemb_grid = posemb[:, :1], posemb[0, 1:]
+        ntok_new -= 1
+    else:
+        posemb_tok, posemb_grid = posemb[:, :0], posemb[0]
+
+    gs_old = int(np.sqrt(len(posemb_grid)))
+    gs_new = int(np.sqrt(ntok_new))
+    print('load_pretrained: grid-size from %s to %s' % (gs_old, gs_new))
+    posemb_grid = posemb_grid.reshape(gs_old, gs_old, -1)
+
+    zoom = (gs_new / gs_old, gs_new / gs_old, 1)
+    posemb_grid = ndimage.zoom(posemb_grid, zoom, order=1)
+    posemb_grid = posemb_grid.reshape(1, gs_new * gs_new, -1)
+    return np2th(np.concatenate([posemb_tok, posemb_grid], axis=1))
+
+
+def npz_to_state_dict(weights):
+    """
+    Converts the tensors of a JAX ViT `.npz` checkpoint into a `VisionTransformer` state dict.
+    This applies the same key mapping and layout changes as `VisionTransformer.load_from`.
+    """
+    def th(key, conv=False):
+        return np2th(np.asarray(weights[key]), conv=conv)
+
+    state_dict = OrderedDict()
+    state_dict["transformer.embeddings.position_embeddings"] = th("Transformer/posembed_input/pos_embedding")
+    state_dict["transformer.embeddings.cls_token"] = th("cls")
+    state_dict["transformer.embeddings.patch_embeddings.weight"] = th("embedding/kernel", conv=True)
+    state_dict["transformer.embeddings.patch_embeddings.bias"] = th("embedding/bias")
+
+    num_blocks = len({int(m.group(1)) for m in (re.match(r"Transformer/encoderblock_(\d+)/", k) for k in weights.keys()) if m})
+    for n_block in range(num_blocks):
+        root = f"Transformer/encoderblock_{n_block}"
+        prefix = f"transformer.encoder.layer.{n_block}."
+        for name, key in (("query", ATTENTION_Q), ("key", ATTENTION_K), ("value", ATTENTION_V), ("out", ATTENTION_OUT)):
+            kernel = th(pjoin(root, key, "kernel"))
+            if name == "out":
+                kernel = kernel.reshape(-1, kernel.size(-1))
+            else:
+                kernel = kernel.reshape(kernel.size(0), -1)
+            state_dict[prefix + f"attn.{name}.weight"] = kernel.t()
+            state_dict[prefix + f"attn.{name}.bias"] = th(pjoin(root, key, "bias")).reshape(-1)
+        state_dict[prefix + "ffn.fc1.weight"] = th(pjoin(root, FC_0, "kernel")).t()
+        state_dict[prefix + "ffn.fc1.bias"] = th(pjoin(root, FC_0, "bias"))
+        state_dict[prefix + "ffn.fc2.weight"] = th(pjoin(root, FC_1, "kernel")).t()
+        state_dict[prefix + "ffn.fc2.bias"] = th(pjoin(root, FC_1, "bias"))
+        state_dict[prefix + "attention_norm.weight"] = th(pjoin(root, ATTENTION_NORM, "scale"))
+        state_dict[prefix + "attention_norm.bias"] = th(pjoin(root, ATTENTION_NORM, "bias"))
+        state_dict[prefix + "ffn_norm.weight"] = th(pjoin(root, MLP_NORM, "scale"))
+        state_dict[prefix + "ffn_norm.bias"] = th(pjoin(root, MLP_NORM, "bias"))
+
+    state_dict["transformer.encoder.encoder_norm.weight"] = th("Transformer/encoder_norm/scale")
+    state_dict["transformer.encoder.encoder_norm.bias"] = th("Transformer/encoder_norm/bias")
+    if "head/kernel" in weights:
+        state_dict["head.weight"] = th("head/kernel").t()
+        state_dict["head.bias"] = th("head/bias")
+    return OrderedDict((k, v.contiguous()) for k, v in state_dict.items())
+
+
+def convert_npz_checkpoint(npz_path, out_path):
+    """One-time conversion of a JAX `.npz` checkpoint into a memory-mappable PyTorch file."""
+    state_dict = npz_to_state_dict(np.load(npz_path))
+    torch.save(state_dict, out_path)
+    logger.info("Converted %s to %s (%d tensors)" % (npz_path, out_path, len(state_dict)))
+    return out_path
+
+
+def build_pretrained(config, pretrained_path, img_size=224, num_classes=21843, zero_head=False, vis=False,
+                     token_keep_ratio=1.0):
+    """
+    Builds a `VisionTransformer` whose parameters map the tensors of a converted checkpoint.
+    The model is constructed on the meta device, so no throwaway random initialization is done,
+    and the file is memory-mapped, so pages are only read when a tensor is first used.
+    """
+    start_time = time.time()
+    with torch.device("meta"):
+        model = VisionTransformer(config, img_size, num_classes=num_classes, zero_head=zero_head, vis=vis,
+                                  token_keep_ratio=token_keep_ratio)
+
+    state_dict = torch.load(pretrained_path, map_location="cpu", mmap=True, weights_only=True)
+    state_dict = OrderedDict(state_dict)
+
+    posemb_new = model.transformer.embeddings.position_embeddings
+    posemb = state_dict["transformer.embeddings.position_embeddings"]
+    if posemb.size() != posemb_new.size():
+        state_dict["transformer.embeddings.position_embeddings"] = resize_pos_embed(
+            posemb, posemb_new.size(1), model.classifier)
+
+    if zero_head or "head.weight" not in state_dict:
+        state_dict["head.weight"] = torch.zeros(model.head.weight.size())
+        state_dict["head.bias"] = torch.zeros(model.head.bias.size())
+
+    model.load_state_dict(state_dict, assign=True)
+    logger.info("Built model from %s in %.2fs" % (pretrained_path, time.time() - start_time))
+    return model
+
+
 CONFIGS = {
+    'testing': configs.get_testing(),
+    'ViT-Ti_16': configs.get_ti16_config(),
+    'ViT-S_16': configs.get_s16_config(),
+    'ViT-B_16': configs.get_b16_config(),
     'ViT-L_16': configs.get_l16_config(),
     'ViT-H_14': configs.get_h14_config()
 }